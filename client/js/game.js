@@ -13,7 +13,7 @@ export const DISCARD_DELAY = 1000;
 export const BEATS_PER_SECOND = 1;
 
 const FILTERED_ACTIONS = [
-  'beat', 'socket_games', 'flush'
+  'beat', 'socket_games', 'socket_games_diff', 'flush'
 ];
 
 const loggerMiddleware = createLogger({
@@ -33,6 +33,7 @@ const INITIAL_GAME = {
   // -- Lobby --
   lobbyStatus: 'normal',
   games: [],
+  gamesVersion: null,
 
   // -- Game conditions --
   player: null,
@@ -57,6 +58,7 @@ const SOCKET_EVENTS = [
   'disconnect',
   'abort',
   'games',
+  'games_diff',
   'room',
   'phase_one',
   'phase_two',
@@ -65,6 +67,7 @@ const SOCKET_EVENTS = [
   'ron',
   'draw',
   'hand',
+  'snapshot',
 ];
 
 
@@ -80,6 +83,11 @@ function reduceGameGeneral(state, action) {
   switch (action.type) {
 
   case 'socket_connect':
+    // The server sends the lobby list, and then pushes every change. Not
+    // needed when rejoining a game (roomKey is cleared below).
+    if (state.status === 'lobby' && !state.roomKey) {
+      state = emit(state, 'subscribe_games');
+    }
     return update(state, { connected: { $set: true }, roomKey: { $set: '' }});
 
   case 'socket_disconnect':
@@ -96,6 +104,9 @@ function reduceGameGeneral(state, action) {
       }}
     });
 
+  case 'socket_snapshot':
+    return applySnapshot(state, action.data);
+
   case 'rejoin':
     state = emit(state, 'rejoin', {'key': action.roomKey});
     return update(state, { roomKey: { $set: action.roomKey }});
@@ -116,7 +127,13 @@ function reduceGameLobby(state, action) {
   switch(action.type) {
 
   case 'socket_games':
-    return update(state, { games: { $set: action.data.games }});
+    return update(state, {
+      games: { $set: action.data.games },
+      gamesVersion: { $set: action.data.version },
+    });
+
+  case 'socket_games_diff':
+    return applyGamesDiff(state, action.data);
 
   case 'socket_room': {
     let { you, nicks, key } = action.data;
@@ -130,12 +147,6 @@ function reduceGameLobby(state, action) {
     });
   }
 
-  case 'beat':
-    if (state.status === 'lobby' && state.beatNum % (3*BEATS_PER_SECOND) === 1)
-      return emit(state, 'get_games');
-    else
-      return state;
-
   case 'set_nick':
     return update(state, { nicks: { you: { $set: action.nick }}});
 
@@ -156,6 +167,25 @@ function reduceGameLobby(state, action) {
   }
 }
 
+function applyGamesDiff(state, diff) {
+  if (diff.version !== state.gamesVersion + 1) {
+    // missed an update, ask for the whole list again
+    return emit(state, 'get_games');
+  }
+  let games = state.games.filter(item => diff.remove.indexOf(item.lobby_id) === -1);
+  for (let item of diff.set) {
+    let i = games.findIndex(game => game.lobby_id === item.lobby_id);
+    if (i === -1)
+      games.push(item);
+    else
+      games[i] = item;
+  }
+  return update(state, {
+    games: { $set: games },
+    gamesVersion: { $set: diff.version },
+  });
+}
+
 function reduceGamePhaseOne(state, action) {
   switch(action.type) {
 
@@ -326,6 +356,26 @@ function replayDiscard(state, tile) {
   return state;
 }
 
+function applySnapshot(state, snapshot) {
+  // Same state as after replaying the messages one by one.
+  state = update(state, {
+    handData: { $set: [] },
+    discards: { $set: [] },
+    opponentDiscards: { $set: snapshot.opponent_discards },
+  });
+  state = reduceGamePhaseOne(state, { type: 'socket_phase_one', data: snapshot });
+  if (snapshot.hand) {
+    state = replayHand(state, snapshot.hand);
+  }
+  if (snapshot.phase >= 2) {
+    state = reduceGamePhaseTwo(state, { type: 'socket_phase_two' });
+  }
+  snapshot.discards.forEach(tile => {
+    state = replayDiscard(state, tile);
+  });
+  return state;
+}
+
 function discard(state, idx) {
   state = emit(state, 'discard', {'tile': state.tiles[idx]});
   return update(state, {
@@ -16,8 +16,8 @@ export function Lobby({
       if (lobbyStatus === 'normal') {
         onJoinPlayer = () => onJoin(item.key);
       }
-      return <LobbyPlayer nick={item.nick} key={i}
-                          onJoin={onJoinPlayer} />;
+      return <LobbyPlayer nick={item.nick} difficulty={item.difficulty}
+                          key={i} onJoin={onJoinPlayer} />;
     }
   });
 
@@ -103,14 +103,14 @@ function LobbyGame({ nicks }) {
   );
 }
 
-function LobbyPlayer({ nick, onJoin }) {
+function LobbyPlayer({ nick, difficulty, onJoin }) {
   let join;
   if (onJoin)
     join = <button className="join" onClick={onJoin}>Join</button>;
 
   return (
     <tr>
-      <LobbyNick nick={nick} />
+      <LobbyNick nick={nick} difficulty={difficulty} />
       <td className="vs"></td>
       <td>
         {join}
@@ -119,9 +119,11 @@ function LobbyPlayer({ nick, onJoin }) {
   );
 }
 
-function LobbyNick({ nick }) {
+function LobbyNick({ nick, difficulty }) {
   nick = nick || 'Anonymous';
-  if (nick === 'Bot')
+  if (nick === 'Bot' && difficulty)
+    return <td><i>{nick}</i> ({difficulty})</td>;
+  else if (nick === 'Bot')
     return <td><i>{nick}</i></td>;
   else
     return <td>{nick}</td>;
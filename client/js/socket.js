@@ -5,19 +5,25 @@ export class Socket {
   constructor() {
     this.queue = [];
     this.handlers = {};
+    // Messages are handled in order, even if some need to be decompressed
+    this.pending = Promise.resolve();
   }
 
   connect(url) {
     console.log('connecting to ' + url);
     this.ws = new WebSocket(url);
+    this.ws.binaryType = 'arraybuffer';
     this.ws.onmessage = this.onMessage.bind(this);
     this.ws.onopen = this.onOpen.bind(this);
     this.ws.onclose = this.onClose.bind(this);
   }
 
   onMessage(message) {
-    let msg = JSON.parse(message.data);
-    this.handle(msg);
+    let data = message.data;
+    this.pending = this.pending
+      .then(() => (data instanceof ArrayBuffer) ? inflate(data) : data)
+      .then(text => this.handle(JSON.parse(text)))
+      .catch(error => console.error(error));
   }
 
   onOpen() {
@@ -48,6 +54,11 @@ export class Socket {
   }
 
   handle(msg) {
+    if (msg.type == 'replay_batch') {
+      msg.messages.forEach(m => this.handle({ type: 'replay', msg: m }));
+      return;
+    }
+
     if (msg.type == 'replay') {
       msg = msg.msg;
       msg.replay = true;
@@ -58,3 +69,9 @@ export class Socket {
     }
   }
 }
+
+// Binary frames are zlib-compressed JSON (see server-py/protocol.py).
+function inflate(buffer) {
+  let stream = new Blob([buffer]).stream().pipeThrough(new DecompressionStream('deflate'));
+  return new Response(stream).text();
+}
@@ -28,6 +28,14 @@ suite('game', function() {
   test('connect', function() {
     this.store.dispatch(actions.socket('connect'));
     assert.isTrue(this.store.getState().connected);
+    assertLastCall(this.store, 'subscribe_games');
+  });
+
+  test('connect after rejoin', function() {
+    this.store.dispatch(actions.rejoin('XYZ'));
+    this.store.dispatch(actions.socket('connect'));
+    let types = this.store.getState().messages.map(msg => msg.type);
+    assert.deepEqual(types, ['rejoin']);
   });
 
   test('disconnect', function() {
@@ -50,14 +58,12 @@ suite('game', function() {
     assert.equal(this.store.getState().beatNum, 0);
 
     this.store.dispatch(actions.beat());
-    assert.equal(this.store.getState().messages.length, 1);
     assert.equal(this.store.getState().beatNum, 1);
-    assertLastCall(this.store, 'get_games');
 
     this.store.dispatch(actions.beat());
     assert.equal(this.store.getState().beatNum, 2);
-    // second beat shouldn't produce another message
-    assert.equal(this.store.getState().messages.length, 1);
+    // the lobby is pushed by the server, no polling
+    assert.equal(this.store.getState().messages.length, 0);
   });
 
   suite('lobby', function() {
@@ -67,6 +73,28 @@ suite('game', function() {
       assert.deepEqual(this.store.getState().games, games);
     });
 
+    test('games diff', function() {
+      let games = [{lobby_id: 'player:A', nick: 'Akagi'},
+                   {lobby_id: 'player:B', nick: 'Bot'}];
+      this.store.dispatch(actions.socket('games', {games, version: 5}));
+      this.store.dispatch(actions.socket('games_diff', {
+        version: 6,
+        remove: ['player:A'],
+        set: [{lobby_id: 'game:1', nicks: ['Akagi', 'Washizu']},
+              {lobby_id: 'player:B', nick: 'Bot', difficulty: 'fast'}],
+      }));
+      assert.deepEqual(this.store.getState().games, [
+        {lobby_id: 'player:B', nick: 'Bot', difficulty: 'fast'},
+        {lobby_id: 'game:1', nicks: ['Akagi', 'Washizu']},
+      ]);
+      assert.equal(this.store.getState().gamesVersion, 6);
+
+      // out of order: ask for the whole list
+      this.store.dispatch(actions.socket('games_diff', {version: 8, remove: [], set: []}));
+      assert.equal(this.store.getState().gamesVersion, 6);
+      assertLastCall(this.store, 'get_games');
+    });
+
     test('join', function() {
       this.store.dispatch(actions.setNick('Akagi'));
       this.store.dispatch(actions.join('XYZ'));
@@ -238,6 +266,22 @@ suite('game', function() {
       assert.deepEqual(this.store.getState().discards, [SAMPLE_TILES[13]]);
     });
 
+    test('snapshot', function() {
+      let store = createSimpleGameStore();
+      let hand = SAMPLE_TILES.slice(0, 13);
+      store.dispatch(actions.socket('snapshot', {
+        tiles: SAMPLE_TILES, 'dora_ind': 'X3', east: 0, you: 0,
+        hand: hand, phase: 2,
+        discards: [SAMPLE_TILES[13]], 'opponent_discards': ['X1'],
+      }));
+      let state = store.getState();
+      assert.equal(state.status, 'phase_two');
+      assert.deepEqual(state.handData, this.store.getState().handData);
+      assert.deepEqual(state.discards, [SAMPLE_TILES[13]]);
+      assert.deepEqual(state.opponentDiscards, ['X1']);
+      assert.equal(state.tiles[13], null);
+    });
+
     suite('game end', function() {
       test('ron', function() {
         let ronInfo = {
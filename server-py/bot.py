@@ -1,6 +1,10 @@
-from collections import Counter
+from collections import Counter, OrderedDict
 import unittest
 import itertools
+import json
+import functools
+import time
+import resource
 
 import gevent
 
@@ -16,10 +20,189 @@ class Multiset(Counter):
 def expand_groups(groups):
     return sum((rules.expand_group(group) for group in groups), [])
 
+# Tiles the bot cannot see in the beginning: 136 - 34 (own) - 1 (dora indicator)
+UNSEEN_TILES = 101
+# Opponent discards, i.e. tiles we can win on
+OPPONENT_DISCARDS = 17
+
+@functools.lru_cache(maxsize=None)
+def prob_none_table(unseen, draws):
+    '''Hypergeometric table: table[w] is the probability that none of w
+    wait tiles is among `draws` tiles drawn from `unseen` ones.'''
+    table = [1.]
+    for i in range(unseen - draws):
+        table.append(table[-1] * (unseen - draws - i) / (unseen - i))
+    # more waits than tiles that stay hidden - one is surely drawn
+    table.extend([0.] * (draws + 1))
+    return tuple(table)
+
+def tenpai_values(rows, unseen=UNSEEN_TILES, draws=OPPONENT_DISCARDS):
+    '''Score many tenpai candidates at once. Each row is a list of
+    (wait count, points) pairs; returns a list of values.'''
+    prob_none = prob_none_table(unseen, draws)
+    values = []
+    for counts_values in rows:
+        wait_count = good_count = expected = 0
+        for cnt, pts in counts_values:
+            wait_count += cnt
+            if pts > 0:
+                good_count += cnt
+                expected += cnt*pts
+        if good_count == 0:
+            values.append(0)
+            continue
+        prob_some = 1 - prob_none[wait_count]
+        # expected points in case of ron, times the ratio of good waits
+        values.append(prob_some * expected * good_count / wait_count**2)
+    return values
+
+def make_wait_patterns():
+    '''Partial shapes that a 13-tile hand can wait with, as
+    (family, shape tiles, waits) tuples.'''
+    patterns = []
+    for tile in rules.ALL_TILES:
+        patterns.append(('tanki', (tile,), frozenset([tile])))
+        patterns.append(('shanpon', (tile, tile), frozenset([tile])))
+    for suit in 'MPS':
+        def t(n):
+            return suit + str(n)
+        for n in range(1, 9):
+            if n == 1:
+                patterns.append(('penchan', (t(1), t(2)), frozenset([t(3)])))
+            elif n == 8:
+                patterns.append(('penchan', (t(8), t(9)), frozenset([t(7)])))
+            else:
+                patterns.append(('ryanmen', (t(n), t(n+1)),
+                                 frozenset([t(n-1), t(n+2)])))
+        for n in range(1, 8):
+            patterns.append(('kanchan', (t(n), t(n+2)), frozenset([t(n+1)])))
+        for n in range(1, 7):
+            patterns.append(('nobetan', (t(n), t(n+1), t(n+2), t(n+3)),
+                             frozenset([t(n), t(n+3)])))
+    return patterns
+
+def make_danger_index():
+    '''Inverted index: tile -> patterns waiting on it. Shapes are stored
+    as (tile, count) pairs.'''
+    index = {tile: [] for tile in rules.ALL_TILES}
+    for family, shape, waits in make_wait_patterns():
+        pattern = (family, tuple(Counter(shape).items()), waits)
+        for tile in waits:
+            index[tile].append(pattern)
+    return index
+
+DANGER_INDEX = make_danger_index()
+
+# COMBINATIONS[n][k] = n choose k, for n, k <= 4
+COMBINATIONS = [[1, 0, 0, 0, 0],
+                [1, 1, 0, 0, 0],
+                [1, 2, 1, 0, 0],
+                [1, 3, 3, 1, 0],
+                [1, 4, 6, 4, 1]]
+
+def danger(tile, unseen_counts, furiten_tiles):
+    '''Estimate how likely the opponent is to win on a tile: the number of
+    ways they could hold a shape waiting on it, given the tiles still
+    unseen. Shapes with any wait in furiten_tiles (the opponent's own
+    discards) can't win and are skipped.'''
+    score = 0
+    for family, shape, waits in DANGER_INDEX[tile]:
+        if not waits.isdisjoint(furiten_tiles):
+            continue
+        ways = 1
+        for shape_tile, need in shape:
+            ways *= COMBINATIONS[max(0, unseen_counts[shape_tile])][need]
+            if ways == 0:
+                break
+        score += ways
+    return score
+
+
+class EvalCache(object):
+    '''LRU cache of eval_waits() results, to be shared between bots.'''
+
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+
+    def get(self, key):
+        value = self.data.get(key)
+        if value is not None:
+            self.data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.data[key] = value
+        if len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+
+def current_rss_kb():
+    '''Resident memory of the process right now, or 0 where /proc isn't
+    available.'''
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return 0
+    return pages * resource.getpagesize() // 1024
+
+
+class SearchStats(object):
+    '''Counters describing a single tenpai search.'''
+
+    FAMILIES = ('3groups', '4groups', '6pairs', 'kokushi')
+
+    def __init__(self):
+        self.generated = {family: 0 for family in self.FAMILIES}
+        self.duplicates = 0
+        self.eval_waits_calls = 0
+        self.eval_cache_hits = 0
+        self.generate_time = 0.
+        self.eval_time = 0.
+        # Growth of the process RSS since the search started. Approximate:
+        # it includes whatever else the process allocated in the meantime.
+        self.start_rss_kb = None
+        self.rss_growth_kb = 0
+
+    @property
+    def total_generated(self):
+        return sum(self.generated.values())
+
+    @property
+    def duplicate_rate(self):
+        return self.duplicates / max(1, self.total_generated)
+
+    def start_memory(self):
+        if self.start_rss_kb is None:
+            self.start_rss_kb = current_rss_kb()
+
+    def update_memory(self):
+        # (not ru_maxrss: that's the high-water mark of the whole process)
+        self.start_memory()
+        growth = current_rss_kb() - self.start_rss_kb
+        self.rss_growth_kb = max(self.rss_growth_kb, growth)
+
+    def as_dict(self):
+        return {
+            'generated': dict(self.generated),
+            'duplicates': self.duplicates,
+            'duplicate_rate': self.duplicate_rate,
+            'eval_waits_calls': self.eval_waits_calls,
+            'eval_cache_hits': self.eval_cache_hits,
+            'generate_time': self.generate_time,
+            'eval_time': self.eval_time,
+            'rss_growth_kb': self.rss_growth_kb,
+        }
+
+
 class Bot(object):
-    def __init__(self, tiles=None, options={}):
+    def __init__(self, tiles=None, options={},
+                 families=SearchStats.FAMILIES, eval_cache=None):
         super(Bot, self).__init__()
         self.options = options
+        self.families = families
+        self.eval_cache = eval_cache
         self.tiles = None
         self.tiles_multiset = None
         self.all_groups = None
@@ -31,6 +214,14 @@ class Bot(object):
         self.tenpai = None
         self.waits = None
         self.safe_tiles = set()
+        self.opponent_discards = Multiset()
+        self.unseen_counts = None
+        self.search_iter = None
+        self.search_position = 0
+        self.search_done = False
+        self.stats = SearchStats()
+        self.candidates = []
+        self.rows = []
 
     def set_tiles(self, tiles):
         self.tiles = tiles
@@ -39,6 +230,7 @@ class Bot(object):
         self.pairs = list(self.find_pairs())
         self.chi_waits = list(self.find_chi_waits())
         self.discard_options = None
+        self.unseen_counts = None
 
     def full_groups(self):
         for i, tile in enumerate(self.tiles):
@@ -123,63 +315,157 @@ class Bot(object):
         else: # 13-way kokushi
             yield sorted(rules.YAOCHU)
 
+    def compute_unseen_counts(self):
+        counts = {tile: 4 for tile in rules.ALL_TILES}
+        for tile in itertools.chain(self.tiles,
+                                    [self.options.get('dora_ind')],
+                                    self.opponent_discards.elements()):
+            if tile in counts:
+                counts[tile] -= 1
+        return counts
+
+    def valuation_params(self):
+        # Opponent discards so far are not among the tiles we can win on.
+        seen = sum(self.opponent_discards.values())
+        return UNSEEN_TILES - seen, OPPONENT_DISCARDS - seen
+
     # softTODO minimalize number of unique tiles in discards
     # softTODO maximalize fan (because uradora)
     def tenpai_value(self, counts_values):
         # heuristics - maybe not very good
-        wait_count = sum(cnt for cnt, pts in counts_values)
-        good_waits = [(cnt, pts) for cnt, pts in counts_values if pts > 0]
-        good_count = sum(cnt for cnt, pts in good_waits)
-        if good_count == 0:
-            return 0
-        prob_none = 1. # probability that no waits are in 17 random tiles
-        for i in range(wait_count):
-            prob_none *= (84 - i)/101. # 101 = 136 - 34 - 1; 84 = 101 - 17
-        prob_some = 1 - prob_none
-        # expected points in case of ron
-        expected_win = 1. * sum(cnt*pts for cnt, pts in good_waits) / wait_count
-        return prob_some * expected_win * good_count/wait_count
+        return self.tenpai_values([counts_values])[0]
+
+    def tenpai_values(self, rows):
+        unseen, draws = self.valuation_params()
+        return tenpai_values(rows, unseen, draws)
 
     def count_waits(self, wait_values):
-        for wait, pts in wait_values:
-            count = 4 - self.tiles.count(wait)
-            count -= int(wait == self.options.get('dora_ind'))
-            yield count, pts
+        if self.unseen_counts is None:
+            self.unseen_counts = self.compute_unseen_counts()
+        return [(self.unseen_counts[wait], pts) for wait, pts in wait_values]
 
     def eval_tenpai(self, tenpai):
-        wait_values = list(
-            rules.eval_waits(list(tenpai), options=self.options))
+        '''Returns (wait count, points) pairs, or None if the tenpai
+        cannot win.'''
+        wait_values = None
+        if self.eval_cache is not None:
+            key = (tenpai, self.options.get('dora_ind'),
+                   tuple(self.options.get('fanpai_winds', ())))
+            wait_values = self.eval_cache.get(key)
+        if wait_values is None:
+            self.stats.eval_waits_calls += 1
+            wait_values = list(
+                rules.eval_waits(list(tenpai), options=self.options))
+            if self.eval_cache is not None:
+                self.eval_cache.put(key, wait_values)
+        else:
+            self.stats.eval_cache_hits += 1
         if any(pts > 0 for wait, pts in wait_values):
-            counts_values = list(self.count_waits(wait_values))
-            return self.tenpai_value(counts_values)
+            return self.count_waits(wait_values)
+
+    def generate_tenpais(self):
+        '''Yields (family, tenpai) pairs, for the families the bot uses.'''
+        generators = {
+            '3groups': self.tenpai_3groups,
+            '4groups': self.tenpai_4groups,
+            '6pairs': self.tenpai_6pairs,
+            'kokushi': self.tenpai_kokushi,
+        }
+        for family in self.families:
+            for t in generators[family]():
+                yield family, t
+
+    def search(self):
+        '''Evaluate tenpai candidates one at a time, yielding after each.
+
+        The progress is kept in the bot, so the search can be abandoned
+        at any point and picked up again by calling search() later.'''
+        if self.search_iter is None:
+            self.search_iter = self.generate_tenpais()
+            self.tenpais = set()
+        stats = self.stats
+        stats.start_memory()
+        while True:
+            start = time.perf_counter()
+            family, t = next(self.search_iter, (None, None))
+            generated = time.perf_counter()
+            stats.generate_time += generated - start
+            if family is None:
+                break
+            self.search_position += 1
+            stats.generated[family] += 1
+            t = tuple(t)
+            if t in self.tenpais:
+                stats.duplicates += 1
+                continue
+            self.tenpais.add(t)
+            counts_values = self.eval_tenpai(t)
+            if counts_values is not None:
+                self.candidates.append(t)
+                self.rows.append(counts_values)
+            stats.eval_time += time.perf_counter() - generated
+            yield
+        stats.update_memory()
+        self.search_done = True
+
+    # Number of best candidates kept in a checkpoint
+    CHECKPOINT_CANDIDATES = 10
+
+    def search_state(self):
+        '''Checkpoint of the search, as plain data. Only the best candidates
+        so far are kept, since the rest can't win anymore.'''
+        values = self.tenpai_values(self.rows)
+        best = sorted(zip(values, range(len(self.rows))), reverse=True)
+        best = sorted(i for value, i in best[:self.CHECKPOINT_CANDIDATES])
+        return {
+            'position': self.search_position,
+            'done': self.search_done,
+            'candidates': [list(self.candidates[i]) for i in best],
+            'rows': [[list(cv) for cv in self.rows[i]] for i in best],
+        }
+
+    def restore_search(self, state):
+        '''Resume a search from a search_state() checkpoint.'''
+        self.candidates = [tuple(t) for t in state['candidates']]
+        self.rows = [[tuple(cv) for cv in row] for row in state['rows']]
+        # Generating candidates is cheap, evaluating them is not: skip the
+        # evaluated ones, remembering them for duplicate detection.
+        self.search_iter = self.generate_tenpais()
+        self.tenpais = set()
+        for family, t in itertools.islice(self.search_iter, state['position']):
+            self.tenpais.add(tuple(t))
+        self.search_position = state['position']
+        self.search_done = state['done']
+
+    def best_tenpai(self):
+        '''Best tenpai among the candidates evaluated so far.'''
+        if not self.candidates:
+            return None
 
-    def choose_tenpai(self, cooperative=False):
+        value, tenpai = max(zip(self.tenpai_values(self.rows), self.candidates))
+        return list(tenpai)
+
+    def top_tenpais(self, k):
+        '''The k best tenpais among the candidates evaluated so far, as
+        (value, tenpai) pairs, best first.'''
+        values = self.tenpai_values(self.rows)
+        best = sorted(zip(values, self.candidates), reverse=True)[:k]
+        return [(value, list(tenpai)) for value, tenpai in best]
+
+    def choose_tenpai(self, cooperative=False, time_budget=None):
+        '''Search for the best tenpai. With time_budget (in seconds), stop
+        early and return the best tenpai found so far.'''
         #print(','.join(sorted(tiles)))
         #print('dora_ind:', options.get('dora_ind'))
-        tenpais = set()
-        evaluated_tenpais = list()
-        for t in itertools.chain(
-            self.tenpai_3groups(),
-            self.tenpai_4groups(),
-            self.tenpai_6pairs(),
-            self.tenpai_kokushi(),
-        ):
+        start = time.perf_counter()
+        for _ in self.search():
             if cooperative:
                 gevent.sleep(0)
-            t = tuple(t)
-            if t in tenpais:
-                continue
-            tenpais.add(t)
-            val = self.eval_tenpai(t)
-            if val is not None:
-                evaluated_tenpais.append((val, t))
-
-        if not evaluated_tenpais:
-            return None
-
-        value, tenpai = max(evaluated_tenpais)
-        tenpai = list(tenpai)
-        return tenpai
+            if (time_budget is not None and
+                    time.perf_counter() - start >= time_budget):
+                self.stats.update_memory()
+                break
+        return self.best_tenpai()
 
     def choose_any_hand(self):
         return self.tiles[:13]
@@ -201,6 +487,8 @@ class Bot(object):
 
     def opponent_discard(self, tile):
         self.safe_tiles.add(tile)
+        self.opponent_discards[tile] += 1
+        self.unseen_counts = None
         return tile in self.waits
 
     def use_discard(self, to_discard):
@@ -208,17 +496,25 @@ class Bot(object):
         self.discard_options.subtract([to_discard])
         return to_discard
 
+    def danger(self, tile):
+        if self.unseen_counts is None:
+            self.unseen_counts = self.compute_unseen_counts()
+        return danger(tile, self.unseen_counts, self.opponent_discards)
+
     def discard(self):
         available_safe = self.discard_options.set() & self.safe_tiles
         if available_safe:
             to_discard = list(available_safe)[0]
         else:
-            for tile, count in self.discard_options.most_common():
-                if tile not in self.waits:
-                    to_discard = tile
-                    break
-            else: # furiten ahoy
-                to_discard = self.discard_options.most_common(1)[0][0]
+            options = self.discard_options.set()
+            # avoid discarding our own waits (furiten), if possible
+            non_waits = options - set(self.waits)
+            if non_waits:
+                options = non_waits
+            to_discard = min(
+                options,
+                key=lambda tile: (self.danger(tile),
+                                  -self.discard_options[tile], tile))
         return to_discard
 
 
@@ -236,6 +532,165 @@ class HelperFunctionsTestCase(unittest.TestCase):
         self.assertEqual(expand_groups([('pon', 'M2'), ('chi', 'M2'), ('chi', 'S1')]),
                          'M2 M2 M2 M2 M3 M4 S1 S2 S3'.split())
 
+    def test_prob_none_table(self):
+        table = prob_none_table(UNSEEN_TILES, OPPONENT_DISCARDS)
+        self.assertEqual(table[0], 1.)
+        # a single wait: 84 of 101 tiles stay hidden
+        self.assertAlmostEqual(table[1], 84/101)
+        self.assertAlmostEqual(table[2], 84/101 * 83/100)
+        self.assertEqual(table[UNSEEN_TILES], 0.)
+
+    def test_tenpai_values(self):
+        bad, good, better = tenpai_values([
+            [(4, 0)],
+            [(2, 8000), (2, 0)],
+            [(2, 8000), (2, 8000)],
+        ])
+        self.assertEqual(bad, 0)
+        self.assertGreater(good, 0)
+        self.assertGreater(better, good)
+        # fewer tiles left to draw - lower chances
+        later, = tenpai_values([[(2, 8000), (2, 8000)]], 91, 7)
+        self.assertLess(later, better)
+
+    def test_count_waits(self):
+        bot = Bot(tiles='M1 M2 M3 M3 P5'.split(), options={'dora_ind': 'P5'})
+        self.assertEqual(bot.count_waits([('M3', 8000), ('P5', 0)]),
+                         [(2, 8000), (2, 0)])
+        bot.waits = []
+        bot.opponent_discard('M3')
+        self.assertEqual(bot.count_waits([('M3', 8000)]), [(1, 8000)])
+        self.assertEqual(bot.valuation_params(),
+                         (UNSEEN_TILES - 1, OPPONENT_DISCARDS - 1))
+
+    def test_search_resume(self):
+        tiles = 'M1 M2 M3 M4 M5 M6 M7 M8 M9 P1 P1 P2 P3 S5 S5'.split()
+        bot = Bot(tiles=tiles, options={'dora_ind': 'X1'})
+        search = bot.search()
+        next(search)
+        self.assertFalse(bot.search_done)
+        self.assertEqual(len(bot.tenpais), 1)
+        # picks up where the interrupted search stopped
+        tenpai = Bot(tiles=tiles, options={'dora_ind': 'X1'}).choose_tenpai()
+        self.assertIsNotNone(tenpai)
+        self.assertEqual(bot.choose_tenpai(), tenpai)
+        self.assertTrue(bot.search_done)
+
+    def test_search_stats(self):
+        bot = Bot(tiles='M1 M2 M3 M4 M5 M6 M7 M8 M9 P1 P1 P2 P3 S5 S5'.split())
+        bot.choose_tenpai()
+        stats = bot.stats.as_dict()
+        self.assertGreater(stats['generated']['3groups'], 0)
+        self.assertEqual(stats['generated']['kokushi'], 0)
+        self.assertEqual(stats['eval_waits_calls'],
+                         bot.stats.total_generated - stats['duplicates'])
+        self.assertGreaterEqual(stats['rss_growth_kb'], 0)
+
+    @unittest.skipIf(current_rss_kb() == 0, 'needs /proc')
+    def test_memory_stats(self):
+        stats = SearchStats()
+        stats.start_memory()
+        data = bytearray(64 * 1024 * 1024)
+        data[::4096] = b'x' * len(data[::4096])
+        stats.update_memory()
+        self.assertGreater(stats.rss_growth_kb, 32 * 1024)
+        del data
+
+        # a later search doesn't inherit the high-water mark
+        stats = SearchStats()
+        stats.start_memory()
+        stats.update_memory()
+        self.assertLess(stats.rss_growth_kb, 32 * 1024)
+
+    def test_choose_tenpai_budget(self):
+        tiles = 'M1 M2 M3 M4 M5 M6 M7 M8 M9 P1 P1 P2 P3 S5 S5'.split()
+        bot = Bot(tiles=tiles)
+        bot.choose_tenpai(time_budget=0)
+        self.assertFalse(bot.search_done)
+        self.assertEqual(len(bot.tenpais), 1)
+
+    def test_families(self):
+        tiles = 'M1 M2 M3 M4 M5 M6 M7 M8 M9 P1 P1 P2 P3 S5 S5'.split()
+        bot = Bot(tiles=tiles, families=('4groups',))
+        self.assertIsNotNone(bot.choose_tenpai())
+        self.assertEqual(bot.stats.generated['3groups'], 0)
+        self.assertGreater(bot.stats.generated['4groups'], 0)
+
+    def test_eval_cache(self):
+        tiles = 'M1 M2 M3 M4 M5 M6 M7 M8 M9 P1 P1 P2 P3 S5 S5'.split()
+        cache = EvalCache(10000)
+        bot1 = Bot(tiles=tiles, eval_cache=cache)
+        bot2 = Bot(tiles=tiles, eval_cache=cache)
+        self.assertEqual(bot1.choose_tenpai(), bot2.choose_tenpai())
+        self.assertEqual(bot2.stats.eval_waits_calls, 0)
+        self.assertEqual(bot2.stats.eval_cache_hits,
+                         bot1.stats.eval_waits_calls)
+
+    def test_eval_cache_size(self):
+        cache = EvalCache(2)
+        cache.put('a', [])
+        cache.put('b', [])
+        cache.get('a')
+        cache.put('c', [])
+        self.assertEqual(list(cache.data), ['a', 'c'])
+
+    def test_top_tenpais(self):
+        tiles = 'M1 M2 M3 M4 M5 M6 M7 M8 M9 P1 P1 P2 P3 S5 S5'.split()
+        bot = Bot(tiles=tiles)
+        tenpai = bot.choose_tenpai()
+        top = bot.top_tenpais(3)
+        self.assertEqual(len(top), 3)
+        self.assertEqual(top[0][1], tenpai)
+        self.assertEqual(len(set(tuple(t) for v, t in top)), 3)
+        self.assertGreaterEqual(top[0][0], top[1][0])
+
+    def test_danger_index(self):
+        families = {family for family, shape, waits in DANGER_INDEX['M4']}
+        self.assertEqual(families,
+                         {'tanki', 'shanpon', 'ryanmen', 'kanchan', 'nobetan'})
+        self.assertEqual({family for family, shape, waits in DANGER_INDEX['X1']},
+                         {'tanki', 'shanpon'})
+
+    def test_danger(self):
+        unseen = {tile: 4 for tile in rules.ALL_TILES}
+        # genbutsu
+        self.assertEqual(danger('M4', unseen, {'M4'}), 0)
+        # suji: M4 discarded, so M1-M4 and M4-M7 ryanmen waits are dead
+        self.assertLess(danger('M1', unseen, {'M4'}), danger('M1', unseen, set()))
+        self.assertLess(danger('M7', unseen, {'M4'}), danger('M7', unseen, set()))
+        # honors are safer than middle tiles
+        self.assertLess(danger('X1', unseen, set()), danger('M5', unseen, set()))
+        # no tiles left to make shapes with
+        unseen['X1'] = 0
+        self.assertEqual(danger('X1', unseen, set()), 0)
+
+    def test_discard(self):
+        bot = Bot(tiles='M1 M2 M3 M4 M5 M6 M7 M8 M9 P1 P1 P2 P3 '
+                  'M5 X1 S3'.split(), options={'dora_ind': 'P9'})
+        bot.use_tenpai('M1 M2 M3 M4 M5 M6 M7 M8 M9 P1 P1 P2 P3'.split())
+        self.assertEqual(bot.discard(), 'X1')
+        bot.opponent_discard('S3')
+        self.assertEqual(bot.discard(), 'S3')
+
+    def test_search_checkpoint(self):
+        tiles = 'M1 M2 M3 M4 M5 M6 M7 M8 M9 P1 P1 P2 P3 S5 S5'.split()
+        full = Bot(tiles=tiles)
+        tenpai = full.choose_tenpai()
+
+        bot = Bot(tiles=tiles)
+        for i, _ in enumerate(bot.search()):
+            if i == 5:
+                break
+        state = json.loads(json.dumps(bot.search_state()))
+        self.assertGreaterEqual(state['position'], 6)
+
+        resumed = Bot(tiles=tiles)
+        resumed.restore_search(state)
+        self.assertEqual(resumed.choose_tenpai(), tenpai)
+        self.assertEqual(resumed.search_position, full.search_position)
+        self.assertLess(resumed.stats.eval_waits_calls,
+                        full.stats.eval_waits_calls)
+
     def test_choose_groups(self):
         groups = [('pon', 'M2'), ('chi', 'M2'), ('chi', 'S1')]
         bot = Bot(tiles='M2 M2 M2 M3 M4 M6 M7 S1 S1 S2 S3'.split())
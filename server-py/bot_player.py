@@ -1,22 +1,125 @@
 
 import logging
+import unittest
 
 import gevent
 
-from bot import Bot
+import rules
+from bot import Bot, EvalCache
+from game import Game
+from scheduler import BotScheduler
 from utils import make_key
 
 logger = logging.getLogger('bot')
 
 
+class SearchSummary(object):
+    '''Aggregates statistics of finished searches, for the server log.'''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.searches = 0
+        self.generated = {}
+        self.duplicates = 0
+        self.eval_waits_calls = 0
+        self.generate_time = 0.
+        self.eval_time = 0.
+        self.max_time = 0.
+        self.max_rss_growth_kb = 0
+
+    def add(self, stats):
+        self.searches += 1
+        for family, count in stats.generated.items():
+            self.generated[family] = self.generated.get(family, 0) + count
+        self.duplicates += stats.duplicates
+        self.eval_waits_calls += stats.eval_waits_calls
+        self.generate_time += stats.generate_time
+        self.eval_time += stats.eval_time
+        self.max_time = max(self.max_time,
+                            stats.generate_time + stats.eval_time)
+        self.max_rss_growth_kb = max(self.max_rss_growth_kb,
+                                     stats.rss_growth_kb)
+
+    def log(self):
+        if self.searches == 0:
+            return
+        total = sum(self.generated.values())
+        logger.info(
+            'searches: %d, generated: %r, duplicate rate: %.2f, '
+            'eval_waits calls: %d, generate time: %.1fs, eval time: %.1fs, '
+            'longest search: %.1fs, max RSS growth in a search: %d kB',
+            self.searches, self.generated, self.duplicates / max(1, total),
+            self.eval_waits_calls, self.generate_time, self.eval_time,
+            self.max_time, self.max_rss_growth_kb)
+        self.reset()
+
+
+search_summary = SearchSummary()
+
+
+# Difficulty levels. For each one:
+#   time_budget - limit for the tenpai search, in seconds (None: unlimited,
+#                 but still subject to the scheduler's budget)
+#   families - kinds of tenpai considered, cheapest first
+#   cache_size - entries in the evaluation cache shared by the bots
+#                (0: don't cache)
+DIFFICULTIES = {
+    'fast': {
+        'time_budget': 5,
+        'families': ('4groups', '6pairs', 'kokushi'),
+        'cache_size': 50000,
+    },
+    'normal': {
+        'time_budget': 30,
+        'families': ('4groups', '6pairs', 'kokushi', '3groups'),
+        'cache_size': 20000,
+    },
+    'strong': {
+        'time_budget': None,
+        'families': ('3groups', '4groups', '6pairs', 'kokushi'),
+        'cache_size': 0,
+    },
+}
+
+DEFAULT_DIFFICULTY = 'normal'
+
+eval_caches = {
+    name: EvalCache(level['cache_size'])
+    for name, level in DIFFICULTIES.items()
+    if level['cache_size'] > 0
+}
+
+
 class BotPlayer(object):
     nick = 'Bot'
+    bot_class = Bot
 
-    def __init__(self):
+    def __init__(self, scheduler=None, difficulty=DEFAULT_DIFFICULTY,
+                 search_state=None):
+        assert difficulty in DIFFICULTIES
         self.key = make_key()
+        self.scheduler = scheduler
+        self.difficulty = difficulty
+        # Saved progress of the search, to resume after restart
+        self.search_state = search_state
+        # Search position in the last checkpoint() (i.e. the last save)
+        self.saved_position = search_state['position'] if search_state else None
+        self.bot = None
         self.thread = None
+        self.job = None
+        self.hand = None
+        self.hand_requested = False
 
     def send(self, msg_type, **msg):
+        if msg_type == 'replay':
+            # Rebuild the state after reconnecting (e.g. server restart).
+            msg = dict(msg['msg'])
+            msg_type = msg.pop('type')
+            if msg_type not in ['phase_one', 'hand', 'discarded']:
+                return
+
         if msg_type == 'phase_one':
             self.on_phase_one(msg)
         elif msg_type == 'hand':
@@ -25,7 +128,9 @@ class BotPlayer(object):
             self.on_discarded(msg)
         elif msg_type == 'start_move':
             self.on_start_move(msg)
-        elif msg_type in ['ron', 'draw', 'aborted']:
+        elif msg_type == 'snapshot':
+            self.on_snapshot(msg)
+        elif msg_type in ['ron', 'draw', 'abort']:
             self.room.remove_player(self.idx)
             self.shutdown()
         else:
@@ -43,29 +148,88 @@ class BotPlayer(object):
             fanpai_wind = 'X1'
         else:
             fanpai_wind = 'X2'
-        self.bot = Bot(
+        self.bot = self.bot_class(
             tiles=tiles,
             options={
                 'dora_ind': dora_ind,
                 'fanpai_winds': [fanpai_wind]
-            }
+            },
+            families=DIFFICULTIES[self.difficulty]['families'],
+            eval_cache=eval_caches.get(self.difficulty),
         )
+        if self.search_state:
+            logger.info('Resuming search from candidate %d',
+                        self.search_state['position'])
+            self.bot.restore_search(self.search_state)
+            self.search_state = None
+        # Start searching right away, without waiting for the move request.
+        self.choose_tenpai()
 
     def on_hand(self, msg):
+        self.stop_search()
         self.bot.use_tenpai(msg['hand'])
 
+    def checkpoint(self):
+        '''Progress of the search, to be saved with the room.'''
+        if self.bot is None:
+            return self.search_state
+        if self.bot.tenpai is not None:
+            return None
+        state = self.bot.search_state()
+        self.saved_position = state['position']
+        return state
+
+    @property
+    def searching(self):
+        '''Whether the search has progress to save.'''
+        return self.bot is not None and self.bot.tenpai is None
+
+    def checkpoint_pending(self):
+        '''Whether the search has progressed since the last checkpoint().'''
+        if self.bot is None or self.bot.tenpai is not None:
+            return False
+        return self.bot.search_position != self.saved_position
+
     def choose_tenpai(self):
-        def run():
-            logger.info('Choosing tenpai...')
-            hand = self.bot.choose_tenpai(cooperative=True)
+        def run(time_budget=None):
+            level_budget = DIFFICULTIES[self.difficulty]['time_budget']
+            if time_budget is None:
+                time_budget = level_budget
+            elif level_budget is not None:
+                time_budget = min(time_budget, level_budget)
+            logger.info('Choosing tenpai (%s)...', self.difficulty)
+            hand = self.bot.choose_tenpai(cooperative=True,
+                                          time_budget=time_budget)
+            logger.info('Search stats: %r', self.bot.stats.as_dict())
+            search_summary.add(self.bot.stats)
             if hand:
                 logger.info('Tenpai found')
             else:
-                # Extremely unlikely.
+                # Extremely unlikely, unless we ran out of time.
                 logger.warning('Tenpai not found, using any hand')
                 hand = self.bot.choose_any_hand()
-            self.room.send_to_game(self.idx, 'hand', hand=hand)
-        self.thread = gevent.spawn(run)
+            self.hand = hand
+            if self.hand_requested:
+                self.send_hand()
+
+        if self.scheduler:
+            self.job = self.scheduler.submit(self.time_left(), run)
+        else:
+            self.thread = gevent.spawn(run)
+
+    def time_left(self):
+        '''Seconds left until the hand move times out.'''
+        game = self.room.game
+        move = game.moves[self.idx]
+        if move is None:
+            # phase_one comes before the move is started
+            return game.HAND_TIME_LIMIT + game.EXTRA_TIME
+        move_type, deadline = move
+        return deadline - game.t
+
+    def send_hand(self):
+        self.hand_requested = False
+        self.room.receive(self.idx, 'hand', hand=self.hand)
 
     def on_discarded(self, msg):
         if msg['player'] == self.idx:
@@ -73,13 +237,252 @@ class BotPlayer(object):
         else:
             self.bot.opponent_discard(msg['tile'])
 
+    def on_snapshot(self, msg):
+        self.on_phase_one(msg)
+        if msg['hand']:
+            self.on_hand(msg)
+        for tile in msg['discards']:
+            self.bot.use_discard(tile)
+        for tile in msg['opponent_discards']:
+            self.bot.opponent_discard(tile)
+
     def on_start_move(self, msg):
         if msg['move_type'] == 'discard':
             tile = self.bot.discard()
-            self.room.send_to_game(self.idx, 'discard', tile=tile)
+            self.room.receive(self.idx, 'discard', tile=tile)
         elif msg['move_type'] == 'hand':
-            self.choose_tenpai()
+            # The search has been running since phase_one; send the hand
+            # now if it's ready, otherwise as soon as it finishes.
+            self.hand_requested = True
+            if self.hand:
+                self.send_hand()
 
     def shutdown(self):
-        if self.thread:
-            self.thread.join()
+        # The search might still be running if the game ended early.
+        self.stop_search()
+
+    def stop_search(self):
+        if self.job:
+            self.scheduler.cancel(self.job)
+        if self.thread and self.thread is not gevent.getcurrent():
+            self.thread.kill()
+
+
+class Suggestions(object):
+    '''Best tenpai hands for a human player, searched for in the background
+    and then kept, so that repeated requests are answered right away.'''
+
+    TIME_BUDGET = 10
+    MAX_HANDS = 5
+
+    def __init__(self, tiles, options, scheduler=None):
+        level = DIFFICULTIES[DEFAULT_DIFFICULTY]
+        self.bot = Bot(tiles=tiles, options=options,
+                       families=level['families'],
+                       eval_cache=eval_caches.get(DEFAULT_DIFFICULTY))
+        self.scheduler = scheduler
+        self.hands = None
+        self.callbacks = []
+        self.thread = None
+        self.job = None
+
+    def request(self, callback):
+        '''Call callback(hands) once the hands are known.'''
+        if self.hands is not None:
+            callback(self.hands)
+            return
+        self.callbacks.append(callback)
+        if not (self.thread or self.job):
+            if self.scheduler:
+                # bot searches have to answer in time, suggestions don't
+                time_left = self.TIME_BUDGET + self.scheduler.SAFETY_MARGIN
+                self.job = self.scheduler.submit(
+                    time_left, self.run, priority=self.scheduler.PRIORITY_LOW)
+            else:
+                self.thread = gevent.spawn(self.run)
+
+    def run(self, time_budget=None):
+        if time_budget is None:
+            time_budget = self.TIME_BUDGET
+        time_budget = min(time_budget, self.TIME_BUDGET)
+        self.bot.choose_tenpai(cooperative=True, time_budget=time_budget)
+        self.hands = [
+            {'hand': hand, 'waits': list(rules.waits(hand)), 'value': value}
+            for value, hand in self.bot.top_tenpais(self.MAX_HANDS)
+        ]
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self.hands)
+
+    def cancel(self):
+        if self.job:
+            self.scheduler.cancel(self.job)
+        if self.thread and self.thread is not gevent.getcurrent():
+            self.thread.kill()
+
+
+class BotPlayerTest(unittest.TestCase):
+    class MockRoom(object):
+        def __init__(self):
+            self.messages = []
+            self.game = Game(callback=lambda *args, **kwargs: None)
+
+        def receive(self, idx, msg_type, **msg):
+            self.messages.append((idx, msg_type, msg))
+
+        def remove_player(self, idx):
+            pass
+
+    def setUp(self):
+        self.room = self.MockRoom()
+        self.player = BotPlayer()
+        self.player.set_room(self.room, 0)
+        self.player.send('phase_one',
+                         tiles='M1 M2 M3 M4 M5 M6 M7 M8 M9 P1 P1 P2 P3 S5 S5'.split(),
+                         dora_ind='X1', you=0, east=0)
+
+    def test_search_before_request(self):
+        self.player.thread.join()
+        self.assertIsNotNone(self.player.hand)
+        self.assertEqual(self.room.messages, [])
+
+        self.player.send('start_move', move_type='hand', time_limit=180)
+        self.assertEqual(self.room.messages,
+                         [(0, 'hand', {'hand': self.player.hand})])
+
+    def test_search_summary(self):
+        summary = SearchSummary()
+        self.player.thread.join()
+        summary.add(self.player.bot.stats)
+        summary.add(self.player.bot.stats)
+        self.assertEqual(summary.searches, 2)
+        self.assertEqual(summary.eval_waits_calls,
+                         2 * self.player.bot.stats.eval_waits_calls)
+        summary.log()
+        self.assertEqual(summary.searches, 0)
+
+    def test_request_before_result(self):
+        self.player.send('start_move', move_type='hand', time_limit=180)
+        self.assertEqual(self.room.messages, [])
+        self.player.thread.join()
+        self.assertEqual(len(self.room.messages), 1)
+
+    def test_difficulty(self):
+        player = BotPlayer(difficulty='fast')
+        player.set_room(self.room, 1)
+        player.send('phase_one',
+                    tiles='M1 M2 M3 M4 M5 M6 M7 M8 M9 P1 P1 P2 P3 S5 S5'.split(),
+                    dora_ind='X1', you=1, east=0)
+        player.thread.join()
+        self.assertIsNotNone(player.hand)
+        self.assertEqual(player.bot.stats.generated['3groups'], 0)
+        self.assertIs(player.bot.eval_cache, eval_caches['fast'])
+
+    def test_suggestions(self):
+        suggestions = Suggestions(
+            'M1 M2 M3 M4 M5 M6 M7 M8 M9 P1 P1 P2 P3 S5 S5'.split(),
+            {'dora_ind': 'X1', 'fanpai_winds': ['X1']})
+        results = []
+        suggestions.request(results.append)
+        suggestions.request(results.append)
+        suggestions.thread.join()
+        self.assertEqual(len(results), 2)
+        self.assertIs(results[0], results[1])
+        hands = results[0]
+        self.assertGreater(len(hands), 1)
+        self.assertLessEqual(len(hands), Suggestions.MAX_HANDS)
+        self.assertTrue(all(len(h['hand']) == 13 and h['waits'] for h in hands))
+
+        # cached now
+        thread = suggestions.thread
+        suggestions.request(results.append)
+        self.assertIs(results[2], hands)
+        self.assertIs(suggestions.thread, thread)
+
+    def test_replay(self):
+        player = BotPlayer()
+        player.set_room(self.room, 0)
+        hand = 'M1 M2 M3 M4 M5 M6 M7 M8 M9 P1 P1 P2 P3'.split()
+        player.send('replay', msg={
+            'type': 'phase_one',
+            'tiles': hand + 'S5 S5'.split(),
+            'dora_ind': 'X1', 'you': 0, 'east': 0})
+        player.send('replay', msg={'type': 'hand', 'hand': hand})
+        player.send('replay', msg={'type': 'discarded', 'player': 1, 'tile': 'S5'})
+        self.assertEqual(player.bot.tenpai, hand)
+        self.assertTrue(player.thread.dead)
+        self.assertIsNone(player.checkpoint())
+
+        player.send('start_move', move_type='discard', time_limit=15)
+        self.assertEqual(self.room.messages, [(0, 'discard', {'tile': 'S5'})])
+
+    def test_snapshot(self):
+        player = BotPlayer()
+        player.set_room(self.room, 0)
+        hand = 'M1 M2 M3 M4 M5 M6 M7 M8 M9 P1 P1 P2 P3'.split()
+        player.send('snapshot', tiles=hand + 'S5 S5 X1'.split(),
+                    dora_ind='X1', you=0, east=0, hand=hand, phase=2,
+                    discards=['X1'], opponent_discards=['S5'])
+        self.assertEqual(player.bot.tenpai, hand)
+        self.assertTrue(player.thread.dead)
+
+        player.send('start_move', move_type='discard', time_limit=15)
+        self.assertEqual(self.room.messages, [(0, 'discard', {'tile': 'S5'})])
+
+    def test_checkpoint(self):
+        player = self.player
+        for i, _ in enumerate(player.bot.search()):
+            if i == 5:
+                break
+        self.assertTrue(player.checkpoint_pending())
+        state = player.checkpoint()
+        self.assertGreater(state['position'], 0)
+        # nothing new to save until the search moves on
+        self.assertFalse(player.checkpoint_pending())
+        next(player.bot.search())
+        self.assertTrue(player.checkpoint_pending())
+
+        player.shutdown()
+        resumed = BotPlayer(search_state=state)
+        resumed.set_room(self.room, 0)
+        self.assertIs(resumed.checkpoint(), state)
+        self.assertFalse(resumed.checkpoint_pending())
+        resumed.send('replay', msg={
+            'type': 'phase_one',
+            'tiles': 'M1 M2 M3 M4 M5 M6 M7 M8 M9 P1 P1 P2 P3 S5 S5'.split(),
+            'dora_ind': 'X1', 'you': 0, 'east': 0})
+        self.assertEqual(resumed.bot.search_position, state['position'])
+        resumed.thread.join()
+        self.assertIsNotNone(resumed.hand)
+
+    def test_scheduler(self):
+        player = BotPlayer(scheduler=BotScheduler())
+        player.set_room(self.room, 1)
+        player.send('phase_one',
+                    tiles='M1 M2 M3 M4 M5 M6 M7 M8 M9 P1 P1 P2 P3 S5 S5'.split(),
+                    dora_ind='X1', you=1, east=0)
+        self.assertEqual(player.time_left(),
+                         Game.HAND_TIME_LIMIT + Game.EXTRA_TIME)
+        player.send('start_move', move_type='hand', time_limit=180)
+        player.job.timer.join()
+        player.job.thread.join()
+        self.assertEqual(self.room.messages,
+                         [(1, 'hand', {'hand': player.hand})])
+
+    def test_abort(self):
+        scheduler = BotScheduler()
+        player = BotPlayer(scheduler=scheduler)
+        player.set_room(self.room, 1)
+        player.send('phase_one',
+                    tiles='M1 M2 M3 M4 M5 M6 M7 M8 M9 P1 P1 P2 P3 S5 S5'.split(),
+                    dora_ind='X1', you=1, east=0)
+        gevent.sleep(0)
+        self.assertFalse(player.job.thread.dead)
+        player.send('abort', culprit=0, description='time limit exceeded')
+        self.assertTrue(player.job.thread.dead)
+        self.assertIsNone(player.hand)
+        self.assertEqual(scheduler.running, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
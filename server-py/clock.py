@@ -0,0 +1,93 @@
+'''Time source for the server.
+
+Everything that waits for wall-clock time (the server's Timer, the bot
+scheduler) goes through a clock object, so that tests can replace real time
+with VirtualClock and run hours of server time in seconds.
+'''
+
+import heapq
+import itertools
+import time
+import unittest
+
+import gevent
+
+
+class RealClock(object):
+    def now(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        gevent.sleep(seconds)
+
+    def spawn_later(self, seconds, fn, *args):
+        '''Run fn(*args) in a new greenlet after the given time. Returns an
+        object with kill().'''
+        return gevent.spawn_later(seconds, fn, *args)
+
+
+class VirtualTimer(object):
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.killed = False
+
+    def kill(self):
+        self.killed = True
+
+
+class VirtualClock(object):
+    '''Clock that moves only when somebody sleeps on it (or calls
+    advance()). Sleeping advances the time immediately and just yields to
+    other greenlets, so a loop sleeping on this clock runs as fast as the CPU
+    allows.'''
+
+    def __init__(self, start=0):
+        self.t = start
+        self.timers = []
+        self.counter = itertools.count()
+
+    def now(self):
+        return self.t
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+        gevent.sleep(0)
+
+    def spawn_later(self, seconds, fn, *args):
+        timer = VirtualTimer(fn, args)
+        heapq.heappush(self.timers,
+                       (self.t + seconds, next(self.counter), timer))
+        return timer
+
+    def advance(self, seconds):
+        self.t += max(0, seconds)
+        while self.timers and self.timers[0][0] <= self.t:
+            _, _, timer = heapq.heappop(self.timers)
+            if not timer.killed:
+                gevent.spawn(timer.fn, *timer.args)
+
+
+class VirtualClockTest(unittest.TestCase):
+    def test_sleep(self):
+        clock = VirtualClock()
+        start = time.monotonic()
+        for i in range(3600):
+            clock.sleep(1)
+        self.assertEqual(clock.now(), 3600)
+        self.assertLess(time.monotonic() - start, 10)
+
+    def test_spawn_later(self):
+        clock = VirtualClock()
+        fired = []
+        clock.spawn_later(10, fired.append, 'a')
+        clock.spawn_later(5, fired.append, 'b')
+        clock.spawn_later(7, fired.append, 'c').kill()
+        clock.sleep(6)
+        self.assertEqual(fired, ['b'])
+        clock.sleep(6)
+        self.assertEqual(fired, ['b', 'a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+'''Running rules computations outside of the event loop.
+
+Game calls self.compute(fn, *args) for the expensive parts of its handlers.
+By default that's inline(), which just calls the function. The server uses
+ThreadCompute, which suspends only the calling greenlet until the result is
+ready; Room holds a lock for the whole handler, so that messages for the
+same room are still processed in order.
+'''
+
+import time
+import unittest
+
+import gevent
+import gevent.threadpool
+
+
+def inline(fn, *args):
+    return fn(*args)
+
+
+class ThreadCompute(object):
+    '''Runs functions in a pool of native threads.
+
+    The functions still need the GIL, but the interpreter hands it back to the
+    event loop every sys.getswitchinterval(), so other connections are served
+    while a long computation is running. (A process pool would avoid the GIL
+    altogether, but doesn't mix well with gevent's monkey-patching.)
+    '''
+
+    def __init__(self, size=2):
+        self.pool = gevent.threadpool.ThreadPool(size)
+
+    def __call__(self, fn, *args):
+        return self.pool.apply(fn, args)
+
+    def shutdown(self):
+        self.pool.kill()
+
+
+class ThreadComputeTest(unittest.TestCase):
+    def setUp(self):
+        self.compute = ThreadCompute(size=1)
+
+    def tearDown(self):
+        self.compute.shutdown()
+
+    def test_result(self):
+        self.assertEqual(self.compute(sorted, [3, 1, 2]), [1, 2, 3])
+
+    def test_exception(self):
+        with self.assertRaises(ZeroDivisionError):
+            self.compute(lambda: 1/0)
+
+    def test_event_loop_runs(self):
+        def busy(duration):
+            end = time.perf_counter() + duration
+            n = 0
+            while time.perf_counter() < end:
+                n += 1
+            return n
+
+        ticks = []
+
+        def tick():
+            while True:
+                ticks.append(time.perf_counter())
+                gevent.sleep(0.001)
+
+        ticker = gevent.spawn(tick)
+        gevent.sleep(0)
+        self.compute(busy, 0.1)
+        ticker.kill()
+        self.assertGreater(len(ticks), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
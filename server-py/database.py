@@ -5,8 +5,9 @@ import json
 import logging
 import copy
 
-from game import Game
-from room import Room
+from game import Game, tile_counts, tiles_from_counts, analyze_hand, wait_mask
+from compute import inline
+from room import Room, RoomLog
 
 
 logger = logging.getLogger('database')
@@ -16,9 +17,14 @@ class Serializer(object):
     cls = None
     exclude_keys = []
 
+    def fields(self, obj):
+        if hasattr(obj, '__dict__'):
+            return obj.__dict__.items()
+        return ((k, getattr(obj, k)) for k in obj.__slots__ if hasattr(obj, k))
+
     def dump(self, obj):
         data = {}
-        for k, v in obj.__dict__.items():
+        for k, v in self.fields(obj):
             if k in self.exclude_keys:
                 continue
             hook = getattr(self, 'dump_'+k, None)
@@ -47,12 +53,73 @@ class Serializer(object):
 
 class GameSerializer(Serializer):
     cls = Game
-    exclude_keys = ['callback']
+    exclude_keys = ['callback', 'broadcast_callback', 'compute']
+
+    # Seeded games are saved without the deal; it's regenerated on load.
+    deal_keys = ['initial_tiles', 'tiles', 'dora_ind', 'uradora_ind']
+
+    def dump(self, game):
+        data = super(GameSerializer, self).dump(game)
+        if game.seed is not None:
+            for k in self.deal_keys:
+                del data[k]
+        return data
+
+    def init(self, game):
+        game.compute = inline
+        if not hasattr(game, 'seed'):
+            # saved before seeded deals, with the tiles
+            game.seed = game.deal_version = None
+        elif game.seed is not None:
+            game.deal(game.seed, game.deal_version)
+            for player in range(2):
+                for tile in game.hand[player] or []:
+                    game.remove_tile(player, tile)
+                for tile in game.discards[player]:
+                    game.remove_tile(player, tile)
+        if not hasattr(game, 'furiten_flags'):
+            # saved before incremental furiten tracking
+            game.wait_mask = [0, 0]
+            game.ron_limits = [None, None]
+            game.furiten_flags = [False, False]
+            for player in range(2):
+                if game.hand[player]:
+                    _, game.ron_limits[player] = analyze_hand(
+                        game.hand[player], game.options(player))
+                    game.wait_mask[player] = wait_mask(game.waits[player])
+                    game.furiten_flags[player] = game.furiten(player)
+
+    # Unseeded games keep the tiles as lists, same as before the compact
+    # representation.
+
+    def dump_initial_tiles(self, initial_tiles):
+        return [list(tiles) for tiles in initial_tiles]
+
+    def load_initial_tiles(self, data):
+        return tuple(tuple(tiles) for tiles in data)
+
+    def dump_tiles(self, tiles):
+        return [tiles_from_counts(counts) for counts in tiles]
+
+    def load_tiles(self, data):
+        return [tile_counts(tiles) for tiles in data]
 
 
 class RoomSerializer(Serializer):
     cls = Room
-    exclude_keys = ['id', 'players']
+    exclude_keys = ['id', 'players', 'suggestions', 'timers', 'clock', 'synced_at',
+                    'journal', 'checkpoint_seq', 'lock',
+                    'mailbox', 'actor', 'mailbox_peak', 'spectators']
+
+    def dump(self, room):
+        data = super(RoomSerializer, self).dump(room)
+        # Save the progress of bot players, if we have them.
+        data['bot_states'] = [
+            player.checkpoint()
+            if hasattr(player, 'checkpoint') else state
+            for player, state in zip(room.players, room.bot_states)
+        ]
+        return data
 
     def dump_game(self, game):
         return GameSerializer().dump(game)
@@ -60,9 +127,39 @@ class RoomSerializer(Serializer):
     def load_game(self, data):
         return GameSerializer().load(data)
 
+    def dump_log(self, log):
+        return [list(entry) for entry in log.entries]
+
+    def load_log(self, data):
+        return RoomLog(data)
+
+    def load_messages(self, data):
+        # Saved before RoomLog: separate lists for both players.
+        return RoomLog((idx, msg_type, msg)
+                       for idx in range(2)
+                       for msg_type, msg in data[idx])
+
     def init(self, room):
+        if hasattr(room, 'messages'):
+            room.log = room.messages
+            del room.messages
         room.players = [None, None]
+        room.suggestions = [None, None]
+        room.spectators = []
+        room.init_timers()
+        if not hasattr(room, 'difficulties'):
+            # saved before the bot difficulty levels
+            room.difficulties = [None, None]
+        if not hasattr(room, 'bot_states'):
+            room.bot_states = [None, None]
+        if not hasattr(room, 'journal_seq'):
+            # saved before the journal
+            room.journal_seq = 0
+        room.init_journal()
+        room.init_lock()
+        room.init_actor()
         room.game.callback = room.send_to_player
+        room.game.broadcast_callback = room.send_to_both
 
 
 SERIALIZERS = {Game: GameSerializer(), Room: RoomSerializer()}
@@ -91,8 +188,25 @@ class Database(object):
                 data BLOB NOT NULL
             );
         ''')
+        # Events since the last checkpoint (saved room) - see Room.record()
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS events (
+                room_id INTEGER NOT NULL,
+                seq INTEGER NOT NULL,
+                data BLOB NOT NULL,
+                PRIMARY KEY (room_id, seq)
+            );
+        ''')
+
+    def append_event(self, room, event):
+        if room.id is None:
+            self.save_room(room)
+        self.conn.execute('''
+            INSERT OR REPLACE INTO events (room_id, seq, data) VALUES (?, ?, ?);
+        ''', [room.id, event['seq'], json.dumps(event)])
 
     def save_room(self, room):
+        '''Save a checkpoint of the room, replacing its journal.'''
         data = to_data(room)
         data_json = json.dumps(data, indent=2)
         cur = self.conn.cursor()
@@ -104,6 +218,10 @@ class Database(object):
         cur.execute('SELECT last_insert_rowid()')
         (id,) = cur.fetchone()
         room.id = id
+        cur.execute('''
+            DELETE FROM events WHERE room_id = ? AND seq <= ?;
+        ''', [room.id, room.journal_seq])
+        room.checkpoint_seq = room.journal_seq
 
     def load_room(self, id):
         cur = self.conn.cursor()
@@ -114,15 +232,28 @@ class Database(object):
     def make_room(self, id, data_json):
         data = json.loads(data_json)
         data['id'] = id
-        return from_data(Room, data)
+        room = from_data(Room, data)
+        # Replay the events since checkpoint.
+        cur = self.conn.cursor()
+        cur.execute('''
+            SELECT data FROM events WHERE room_id = ? AND seq > ? ORDER BY seq
+        ''', [id, room.journal_seq])
+        for (event_json,) in cur.fetchall():
+            room.replay_event(json.loads(event_json))
+        return room
 
     def load_unfinished_rooms(self):
         cur = self.conn.cursor()
         cur.execute('''SELECT rowid, data FROM rooms WHERE NOT finished''')
-        return [
-            self.make_room(id, data_json)
-            for (id, data_json) in cur.fetchall()
-        ]
+        rooms = []
+        for (id, data_json) in cur.fetchall():
+            room = self.make_room(id, data_json)
+            if room.finished:
+                # finished after the last checkpoint
+                self.save_room(room)
+            else:
+                rooms.append(room)
+        return rooms
 
     def dump_active_rooms(self):
         cur = self.conn.cursor()
@@ -145,6 +276,50 @@ class SerializationTest(unittest.TestCase):
     def test_serialize_room(self):
         self._test_serialize(Room, Room())
 
+    def test_serialize_started_game(self):
+        game = Game(seed=5)
+        hand = list(game.initial_tiles[0][:13])
+        game.on_hand(0, hand=hand)
+        data = to_data(game)
+        self.assertNotIn('initial_tiles', data)
+        loaded_game = from_data(Game, data)
+        self.assertEqual(loaded_game.initial_tiles, game.initial_tiles)
+        self.assertEqual(loaded_game.tiles, game.tiles)
+        self.assertEqual(loaded_game.uradora_ind, game.uradora_ind)
+
+    def test_load_old_furiten(self):
+        game = Game(seed=5)
+        for player in range(2):
+            game.on_hand(player, hand=list(game.initial_tiles[player][:13]))
+        data = to_data(game)
+        for k in ['wait_mask', 'ron_limits', 'furiten_flags']:
+            del data[k]
+        loaded_game = from_data(Game, data)
+        self.assertEqual(to_data(loaded_game), to_data(game))
+
+    def test_load_old_messages(self):
+        room = Room()
+        room.start_game()
+        data = to_data(room)
+        del data['log']
+        data['messages'] = [room.log.messages(idx) for idx in range(2)]
+        data = json.loads(json.dumps(data))
+        loaded_room = from_data(Room, data)
+        for idx in range(2):
+            self.assertEqual(loaded_room.log.messages(idx),
+                             [tuple(m) for m in data['messages'][idx]])
+
+    def test_load_old_game(self):
+        game = Game()
+        game.seed = None
+        data = to_data(game)
+        del data['seed'], data['deal_version']
+        # before count vectors, remaining tiles were kept in deal order
+        data['tiles'] = [list(reversed(tiles)) for tiles in data['tiles']]
+        game = from_data(Game, data)
+        self.assertEqual(game.remaining_tiles(0), sorted(data['tiles'][0]))
+        self.assertEqual(game.initial_tiles[0], tuple(data['initial_tiles'][0]))
+
 
 class DatabaseTest(unittest.TestCase):
     def setUp(self):
@@ -174,6 +349,47 @@ class DatabaseTest(unittest.TestCase):
         loaded_room = self.db.load_room(room.id)
         self.assertDataEquals(room, loaded_room)
 
+    def test_save_bot_state(self):
+        class MockBot(object):
+            def set_room(self, room, idx):
+                pass
+
+            def checkpoint(self):
+                return {'position': 10}
+
+        room = Room()
+        room.add_player(1, MockBot())
+        self.db.save_room(room)
+        loaded_room = self.db.load_room(room.id)
+        self.assertEqual(loaded_room.bot_states, [None, {'position': 10}])
+
+    def test_journal(self):
+        room = Room()
+        self.db.save_room(room)
+        room.journal = self.db.append_event
+        room.start_game()
+        room.game.t = 5
+        hand = list(room.game.initial_tiles[1][:13])
+        room.send_to_game(1, 'hand', hand=hand)
+        loaded_room = self.db.load_room(room.id)
+        self.assertDataEquals(room, loaded_room)
+        self.assertEqual(loaded_room.game.t, 5)
+
+        # checkpoint removes the events
+        self.db.save_room(room)
+        cur = self.db.conn.execute('''SELECT COUNT(*) FROM events''')
+        self.assertEqual(cur.fetchone(), (0,))
+        self.assertDataEquals(room, self.db.load_room(room.id))
+
+    def test_journal_finished(self):
+        room = Room()
+        self.db.save_room(room)
+        room.journal = self.db.append_event
+        room.start_game()
+        room.abort()
+        self.assertEqual(self.db.load_unfinished_rooms(), [])
+        self.assertEqual(self.db.load_unfinished_rooms(), [])
+
     def test_load_unfinished(self):
         room1 = Room()
         room2 = Room()
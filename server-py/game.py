@@ -2,10 +2,9 @@ import random
 import unittest
 
 import rules
+from compute import inline
 
 
-DEBUG = False
-
 TILES = rules.ALL_TILES * 4
 PLAYER_TILES = 34
 DISCARDS = 17
@@ -16,7 +15,61 @@ def dummy_callback(to_player, msg_type, **msg_data):
     import pprint
     pprint.pprint((to_player, msg_type, msg_data))
 
+def tile_counts(tiles):
+    '''Count vector of tiles, indexed by rules.TILE_INDEX.'''
+    counts = bytearray(len(rules.ALL_TILES))
+    for tile in tiles:
+        counts[rules.TILE_INDEX[tile]] += 1
+    return counts
+
+def tiles_from_counts(counts):
+    return [tile for tile, count in zip(rules.ALL_TILES, counts)
+            for _ in range(count)]
+
+def wait_mask(tiles):
+    '''Bitmask of tiles, indexed by rules.TILE_INDEX.'''
+    mask = 0
+    for tile in tiles:
+        mask |= 1 << rules.TILE_INDEX[tile]
+    return mask
+
+def analyze_hand(hand, options):
+    '''Returns the waits of a hand, and for each wait, the limit of the best
+    winning hand: without and with one bonus fan (ippatsu or hotei, which
+    are never combined).'''
+    waits = list(rules.waits(hand))
+    limits = {}
+    for wait in waits:
+        full_hand = sorted(hand + [wait])
+        limits[wait] = [
+            rules.best_hand(full_hand, wait, dict(options, ippatsu=bonus)).limit()
+            for bonus in [False, True]
+        ]
+    return waits, limits
+
 class Game(object):
+    __slots__ = (
+        'callback',
+        'broadcast_callback',
+        'compute',
+        'seed',
+        'deal_version',
+        'east',
+        'initial_tiles',
+        'tiles',
+        'dora_ind',
+        'uradora_ind',
+        'hand',
+        'waits',
+        'wait_mask',
+        'ron_limits',
+        'furiten_flags',
+        'discards',
+        't',
+        'moves',
+        'finished',
+    )
+
     # Time limits, in seconds
     DISCARD_TIME_LIMIT = 15
     HAND_TIME_LIMIT = 3*60
@@ -24,33 +77,44 @@ class Game(object):
     # Additional leeway to accomodate connection problems and UI updates
     EXTRA_TIME = 10
 
+    # Version of the dealing algorithm. The deal is regenerated from the seed
+    # when loading a game, so bump it (keeping the old code) whenever deal()
+    # would produce a different result for the same seed.
+    DEAL_VERSION = 1
+
     def __init__(self,
                  east=None,
-                 callback=dummy_callback):
+                 callback=dummy_callback,
+                 seed=None,
+                 broadcast=None):
         self.callback = callback
-
-        all_tiles = list(TILES)
-
-        if not DEBUG:
-            random.shuffle(all_tiles)
+        # broadcast(msg_type, **msg) sends a message to both players
+        # (by default, callback is called for each of them)
+        self.broadcast_callback = broadcast
+        # compute(fn, *args) runs rules computations (see compute.py)
+        self.compute = inline
+
+        if seed is None:
+            seed = random.SystemRandom().getrandbits(63)
+        self.seed = seed
+        self.deal_version = self.DEAL_VERSION
+        rng = self.deal(seed, self.deal_version)
 
         if east == None:
-            self.east = random.randrange(2)
+            self.east = rng.randrange(2)
         else:
             self.east = east
 
-        # Tiles available for players
-        n = PLAYER_TILES
-        self.initial_tiles = [all_tiles[:n], all_tiles[n:n*2]]
-        self.tiles = [all_tiles[:n], all_tiles[n:n*2]]
-
-        self.dora_ind = all_tiles[n*2]
-        self.uradora_ind = all_tiles[n*2+1]
-
         # Players' hands (None until they've chosen them)
         self.hand = [None, None]
 
         self.waits = [None, None]
+        # Waits as bitmasks (see wait_mask())
+        self.wait_mask = [0, 0]
+        # Wait -> limits of the winning hand (see analyze_hand())
+        self.ron_limits = [None, None]
+        # Updated with every discard
+        self.furiten_flags = [False, False]
 
         self.discards = [[], []]
 
@@ -62,6 +126,30 @@ class Game(object):
 
         self.finished = False
 
+    def deal(self, seed, version):
+        '''Deal the tiles determined by seed. Returns the random generator,
+        for further use.'''
+
+        if version != 1:
+            raise ValueError('unknown deal version: %r' % version)
+        rng = random.Random(seed)
+        all_tiles = self.shuffle_tiles(rng)
+
+        # Tiles dealt to players (immutable, so they can be shared)
+        n = PLAYER_TILES
+        self.initial_tiles = (tuple(all_tiles[:n]), tuple(all_tiles[n:n*2]))
+        # Tiles still available for players, as count vectors
+        self.tiles = [tile_counts(tiles) for tiles in self.initial_tiles]
+
+        self.dora_ind = all_tiles[n*2]
+        self.uradora_ind = all_tiles[n*2+1]
+        return rng
+
+    def shuffle_tiles(self, rng):
+        all_tiles = list(TILES)
+        rng.shuffle(all_tiles)
+        return all_tiles
+
     @property
     def phase(self):
         # First phase - hand selection
@@ -74,6 +162,16 @@ class Game(object):
         else:
             return 3
 
+    def has_tile(self, player, tile):
+        idx = rules.TILE_INDEX.get(tile)
+        return idx is not None and self.tiles[player][idx] > 0
+
+    def remove_tile(self, player, tile):
+        self.tiles[player][rules.TILE_INDEX[tile]] -= 1
+
+    def remaining_tiles(self, player):
+        return tiles_from_counts(self.tiles[player])
+
     @property
     def player_turn(self):
         if len(self.discards[0]) == len(self.discards[1]):
@@ -84,26 +182,41 @@ class Game(object):
     def abort(self, culprit, description):
         '''Abort the game and provide explanation.'''
 
-        for i in range(2):
-            self.callback(i, 'abort', culprit=culprit, description=description)
-            self.finished = True
+        self.broadcast('abort', culprit=culprit, description=description)
+        self.finished = True
         self.moves = [None, None]
 
     def beat(self):
         '''Make time advance by 1 second in the game, handling possible timeouts.
         To be called by external code. Optional.'''
-        self.t += 1
+        self.advance(self.t + 1)
+
+    def advance(self, t):
+        '''Make time advance to t seconds, handling possible timeouts.'''
+        self.t = max(self.t, t)
         for i in range(2):
             if self.moves[i] is not None and self.t >= self.moves[i][1]:
                 self.abort(i, 'time limit exceeded')
                 return
 
+    def next_deadline(self):
+        '''The earliest time a move can time out, or None.'''
+        deadlines = [move[1] for move in self.moves if move is not None]
+        return min(deadlines) if deadlines else None
+
     def start_move(self, player, move_type, time_limit):
         assert self.moves[player] is None
         deadline = self.t + time_limit + self.EXTRA_TIME
         self.moves[player] = (move_type, deadline)
         self.send_move(player)
 
+    def broadcast(self, msg_type, **msg):
+        if self.broadcast_callback:
+            self.broadcast_callback(msg_type, **msg)
+        else:
+            for i in range(2):
+                self.callback(i, msg_type, **msg)
+
     def end_move(self, player):
         self.moves[player] = None
         self.callback(player, 'end_move')
@@ -120,7 +233,7 @@ class Game(object):
     def start(self):
         for i in range(2):
             self.callback(i, 'phase_one',
-                          tiles=self.initial_tiles[i],
+                          tiles=list(self.initial_tiles[i]),
                           dora_ind=self.dora_ind,
                           you=i,
                           east=self.east)
@@ -137,15 +250,15 @@ class Game(object):
             self.abort(player, 'on_hand: hand already sent')
             return
         for tile in hand:
-            # this fails if a player doesn't have a tile
-            try:
-                self.tiles[player].remove(tile)
-            except ValueError:
+            if not self.has_tile(player, tile):
                 self.abort(player, 'on_hand: tile not found in choices')
                 return
+            self.remove_tile(player, tile)
 
         self.hand[player] = hand
-        self.waits[player] = list(rules.waits(hand))
+        self.waits[player], self.ron_limits[player] = self.compute(
+            analyze_hand, hand, self.options(player))
+        self.wait_mask[player] = wait_mask(self.waits[player])
 
         self.end_move(player)
 
@@ -154,12 +267,25 @@ class Game(object):
 
         if self.hand[0] and self.hand[1]:
             # start the second phase
-            for i in range(2):
-                self.callback(i, 'phase_two')
+            self.broadcast('phase_two')
             self.start_move(self.east, 'discard', self.DISCARD_TIME_LIMIT)
         else:
             self.callback(player, 'wait_for_phase_two')
 
+    def snapshot(self, player):
+        '''State of the game as seen by player, for reconnecting (instead of
+        replaying all the messages).'''
+        return {
+            'tiles': list(self.initial_tiles[player]),
+            'dora_ind': self.dora_ind,
+            'you': player,
+            'east': self.east,
+            'hand': self.hand[player],
+            'phase': self.phase,
+            'discards': list(self.discards[player]),
+            'opponent_discards': list(self.discards[1-player]),
+        }
+
     def options(self, player, uradora=False):
         return {
             'fanpai_winds': [SEAT_WINDS[player^self.east]],
@@ -170,6 +296,8 @@ class Game(object):
         }
 
     def furiten(self, player):
+        '''Check furiten from scratch (on_discard keeps furiten_flags up to
+        date instead).'''
         tiles = set(self.discards[player] + self.discards[1-player][:-1])
         return any(wait in tiles for wait in self.waits[player])
 
@@ -180,71 +308,78 @@ class Game(object):
         if self.player_turn != player:
             self.abort(player, 'on_discard: not your turn')
             return
-        if tile not in self.tiles[player]:
+        if not self.has_tile(player, tile):
             self.abort(player, 'on_discard: tile not found in choices')
             return
 
-        self.tiles[player].remove(tile)
+        self.remove_tile(player, tile)
         self.discards[player].append(tile)
 
         self.end_move(player)
 
-        for i in range(2):
-            self.callback(i, 'discarded',
-                          player=player,
-                          tile=tile)
+        self.broadcast('discarded', player=player, tile=tile)
+
+        bit = 1 << rules.TILE_INDEX[tile]
+        # discarding own wait
+        if self.wait_mask[player] & bit:
+            self.furiten_flags[player] = True
 
         # ron
-        if tile in self.waits[1-player] and not self.furiten(1-player):
-            if self.check_ron(player, tile):
+        if self.wait_mask[1-player] & bit:
+            if not self.furiten_flags[1-player] and self.check_ron(player, tile):
                 return
+            # passing on a wait
+            self.furiten_flags[1-player] = True
 
         # draw
         if len(self.discards[0]) == len(self.discards[1]) == DISCARDS:
             self.finished = True
-            for i in range(2):
-                self.callback(i, 'draw')
+            self.broadcast('draw')
         # normal turn
         else:
             self.start_move(self.player_turn, 'discard', self.DISCARD_TIME_LIMIT)
 
     def check_ron(self, player, tile):
-        full_hand = sorted(self.hand[1-player] + [tile])
-        hand = rules.best_hand(full_hand, tile, options=self.options(1-player))
+        options = self.options(1-player)
+        bonus = options['ippatsu'] or options['hotei']
         # Check mangan limit
-        if hand.limit() == 0:
+        if self.ron_limits[1-player][tile][bonus] == 0:
             return False
 
-        # Compute again, with uradora
-        hand = rules.best_hand(full_hand, tile,
-                               options=self.options(1-player, uradora=True))
+        # Compute the hand, with uradora
+        full_hand = sorted(self.hand[1-player] + [tile])
+        hand = self.compute(rules.best_hand, full_hand, tile,
+                            self.options(1-player, uradora=True))
         self.finished = True
-        for i in range(2):
-            self.callback(i, 'ron',
-                player=1-player,
-                hand=full_hand,
-                tile=tile,
-                yaku=hand.yaku,
-                yakuman=hand.yakuman,
-                dora=hand.dora(),
-                points=rules.BASE_POINTS[hand.limit()],
-                limit=hand.limit(),
-                uradora_ind=self.uradora_ind,
-            )
+        self.broadcast('ron',
+            player=1-player,
+            hand=full_hand,
+            tile=tile,
+            yaku=hand.yaku,
+            yakuman=hand.yakuman,
+            dora=hand.dora(),
+            points=rules.BASE_POINTS[hand.limit()],
+            limit=hand.limit(),
+            uradora_ind=self.uradora_ind,
+        )
 
         return True
 
 
+class UnshuffledGame(Game):
+    __slots__ = ()
+
+    def shuffle_tiles(self, rng):
+        return list(TILES)
+
+
 class GameTestCase(unittest.TestCase):
     def setUp(self):
         from collections import deque
 
-        global DEBUG
-        DEBUG = True # suppress randomization
-
         self.messages = deque()
 
-        self.g = Game(east=0, callback=self.callback)
+        self.g = UnshuffledGame(east=0, callback=self.callback)
         self.g.start()
 
     def assertMessage(self, player, msg_type, msg={}):
@@ -296,7 +431,7 @@ class GameTestCase(unittest.TestCase):
         for i in range(DISCARDS):
             for j in range(2):
                 # Just discard the first choice
-                t = self.g.tiles[j][0]
+                t = self.g.remaining_tiles(j)[0]
                 self.discard(j, t)
         self.assertMessageBoth('draw')
 
@@ -348,6 +483,18 @@ class GameTestCase(unittest.TestCase):
         # P1 would win now, but she's in furiten
         self.discard(0, 'S5')
         self.assertNoMessage('ron')
+        self.assertEqual(self.g.furiten_flags, [False, True])
+        self.assertTrue(self.g.furiten(1))
+
+    def test_ron_limits(self):
+        self.start_game('M2 M9 P1 P9 S1 S9 X1 X2 X3 X4 X5 X6 X7',
+                        'M6 M7 M8 P6 P7 P8 S2 S3 S4 S5 S6 S7 S8')
+        # riichi tanyao sanshoku is mangan even without ippatsu,
+        # riichi ippatsu tanyao is not
+        self.assertEqual(self.g.ron_limits[1],
+                         {'S2': [1, 1], 'S5': [1, 1], 'S8': [0, 0]})
+        self.assertEqual(self.g.wait_mask[1],
+                         wait_mask(['S2', 'S5', 'S8']))
 
     def test_short_hand(self):
         self.test_init()
@@ -372,6 +519,16 @@ class GameTestCase(unittest.TestCase):
             self.g.beat()
         self.assertMessageBoth('abort', {'culprit': 1, 'description': 'time limit exceeded'})
 
+    def test_advance(self):
+        self.test_init()
+        deadline = self.g.HAND_TIME_LIMIT + self.g.EXTRA_TIME
+        self.assertEqual(self.g.next_deadline(), deadline)
+        self.g.advance(deadline - 1)
+        self.assertFalse(self.g.finished)
+        self.g.advance(deadline)
+        self.assertMessageBoth('abort', {'culprit': 0, 'description': 'time limit exceeded'})
+        self.assertIsNone(self.g.next_deadline())
+
     def test_discard_time_limit(self):
         self.start_game('M1 M2 M3 M4 M5 M6 M7 M8 M9 P1 P2 P3 P4',
                         'M1 M2 M3 M4 M5 M6 M7 M8 M9 P1 P2 P3 P4')
@@ -381,5 +538,21 @@ class GameTestCase(unittest.TestCase):
         self.assertMessageBoth('abort', {'culprit': 0, 'description': 'time limit exceeded'})
 
 
+class GameSeedTest(unittest.TestCase):
+    def test_same_seed(self):
+        g1 = Game(seed=123)
+        g2 = Game(seed=123)
+        self.assertEqual(g1.initial_tiles, g2.initial_tiles)
+        self.assertEqual((g1.east, g1.dora_ind, g1.uradora_ind),
+                         (g2.east, g2.dora_ind, g2.uradora_ind))
+
+    def test_does_not_use_global_random(self):
+        random.seed(1)
+        g1 = Game()
+        random.seed(1)
+        g2 = Game()
+        self.assertNotEqual(g1.seed, g2.seed)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,103 @@
+'''The list of games and waiting players shown in the lobby.'''
+
+import unittest
+import json
+from collections import OrderedDict
+
+from protocol import encode
+
+
+class Lobby(object):
+    '''Lobby items, updated as games are created, joined and finished.
+
+    Subscribers get the whole list once ('games'), and then only the changes
+    ('games_diff'). Every change is encoded once for all subscribers, and
+    the full list is encoded only when somebody asks for it after a change.
+    Subscribers need send_data(data), for already encoded messages.
+    '''
+
+    def __init__(self):
+        # lobby_id -> item
+        self.items = OrderedDict()
+        self.version = 0
+        self.subscribers = set()
+        self._payload = None
+
+    def games(self):
+        return list(self.items.values())
+
+    @property
+    def payload(self):
+        if self._payload is None:
+            self._payload = encode('games', games=self.games(),
+                                   version=self.version)
+        return self._payload
+
+    def set(self, lobby_id, item):
+        item = dict(item, lobby_id=lobby_id)
+        self.items[lobby_id] = item
+        self.changed(set=[item], remove=[])
+
+    def remove(self, lobby_id):
+        if self.items.pop(lobby_id, None) is not None:
+            self.changed(set=[], remove=[lobby_id])
+
+    def changed(self, **diff):
+        self.version += 1
+        self._payload = None
+        if self.subscribers:
+            data = encode('games_diff', version=self.version, **diff)
+            for player in list(self.subscribers):
+                player.send_data(data)
+
+    def subscribe(self, player):
+        self.subscribers.add(player)
+        player.send_data(self.payload)
+
+    def unsubscribe(self, player):
+        self.subscribers.discard(player)
+
+
+class LobbyTest(unittest.TestCase):
+    class MockPlayer(object):
+        def __init__(self):
+            self.messages = []
+
+        def send_data(self, data):
+            self.messages.append(json.loads(data))
+
+    def test_subscribe(self):
+        lobby = Lobby()
+        lobby.set('player:A', {'type': 'player', 'nick': 'Akagi'})
+        player = self.MockPlayer()
+        lobby.subscribe(player)
+        self.assertEqual(player.messages, [{
+            'type': 'games', 'version': 1,
+            'games': [{'type': 'player', 'nick': 'Akagi', 'lobby_id': 'player:A'}],
+        }])
+
+        lobby.remove('player:A')
+        lobby.set('game:1', {'type': 'game', 'nicks': ['Akagi', 'Washizu']})
+        lobby.remove('nonexistent')
+        self.assertEqual(player.messages[1:], [
+            {'type': 'games_diff', 'version': 2, 'set': [], 'remove': ['player:A']},
+            {'type': 'games_diff', 'version': 3, 'remove': [],
+             'set': [{'type': 'game', 'nicks': ['Akagi', 'Washizu'],
+                      'lobby_id': 'game:1'}]},
+        ])
+
+        lobby.unsubscribe(player)
+        lobby.remove('game:1')
+        self.assertEqual(len(player.messages), 3)
+
+    def test_payload_cached(self):
+        lobby = Lobby()
+        lobby.set('player:A', {'type': 'player'})
+        payload = lobby.payload
+        self.assertIs(lobby.payload, payload)
+        lobby.remove('player:A')
+        self.assertEqual(json.loads(lobby.payload)['games'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+'''Encoding of the messages sent to the clients.'''
+
+import json
+import unittest
+import zlib
+
+
+# Batches larger than that (in bytes) are compressed
+COMPRESS_MIN_SIZE = 4096
+
+
+def encode(msg_type, **msg):
+    return json.dumps({'type': msg_type, **msg})
+
+
+def encode_batch(messages, compress_min_size=COMPRESS_MIN_SIZE):
+    '''Encode a list of replayed messages as one 'replay_batch' message.
+    Large batches are zlib-compressed, and have to be sent as a binary
+    frame.'''
+    encoded = encode('replay_batch', messages=messages)
+    if len(encoded) < compress_min_size:
+        return encoded
+    return zlib.compress(encoded.encode())
+
+
+class Frame(object):
+    '''A message for several recipients, encoded only once (when first
+    needed).'''
+
+    __slots__ = ('msg_type', 'msg', '_encoded')
+
+    def __init__(self, msg_type, msg):
+        self.msg_type = msg_type
+        self.msg = msg
+        self._encoded = None
+
+    @property
+    def encoded(self):
+        if self._encoded is None:
+            self._encoded = encode(self.msg_type, **self.msg)
+        return self._encoded
+
+
+class FrameTest(unittest.TestCase):
+    def test_encoded_once(self):
+        frame = Frame('discarded', {'player': 0, 'tile': 'M1'})
+        self.assertEqual(json.loads(frame.encoded),
+                         {'type': 'discarded', 'player': 0, 'tile': 'M1'})
+        self.assertIs(frame.encoded, frame.encoded)
+
+
+class BatchTest(unittest.TestCase):
+    MESSAGES = [{'type': 'discarded', 'player': i % 2, 'tile': 'M1'}
+                for i in range(20)]
+
+    def test_small(self):
+        encoded = encode_batch(self.MESSAGES)
+        self.assertIsInstance(encoded, str)
+        self.assertEqual(json.loads(encoded),
+                         {'type': 'replay_batch', 'messages': self.MESSAGES})
+
+    def test_compressed(self):
+        encoded = encode_batch(self.MESSAGES, compress_min_size=100)
+        self.assertIsInstance(encoded, bytes)
+        self.assertEqual(json.loads(zlib.decompress(encoded)),
+                         {'type': 'replay_batch', 'messages': self.MESSAGES})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+'''Rooms held in memory by the server.'''
+
+import unittest
+
+from room import Room
+
+
+class RoomRegistry(object):
+    '''Rooms indexed by ID and by player key. Iterating goes over the rooms
+    in the order they were added.
+
+    Finished rooms are also kept apart (see mark_finished()), so that they
+    can be evicted without going over all the rooms.'''
+
+    def __init__(self, rooms=()):
+        self.by_id = {}
+        # key -> (room, seat)
+        self.by_key = {}
+        # ID -> finished room
+        self.finished = {}
+        for room in rooms:
+            self.add(room)
+
+    def add(self, room):
+        assert room.id is not None, 'room has to be saved first'
+        self.by_id[room.id] = room
+        for idx, key in enumerate(room.keys):
+            self.by_key[key] = (room, idx)
+        if room.finished:
+            self.mark_finished(room)
+
+    def mark_finished(self, room):
+        if room.id in self.by_id:
+            self.finished[room.id] = room
+
+    def finished_rooms(self):
+        return list(self.finished.values())
+
+    def remove(self, room):
+        del self.by_id[room.id]
+        self.finished.pop(room.id, None)
+        for key in room.keys:
+            self.by_key.pop(key, None)
+
+    def get(self, room_id):
+        return self.by_id.get(room_id)
+
+    def find_key(self, key):
+        '''Returns (room, seat), or (None, None) if the key is not found.'''
+        return self.by_key.get(key, (None, None))
+
+    def __iter__(self):
+        return iter(list(self.by_id.values()))
+
+    def __len__(self):
+        return len(self.by_id)
+
+
+class RoomRegistryTest(unittest.TestCase):
+    def make_room(self, id):
+        room = Room()
+        room.id = id
+        return room
+
+    def test_lookup(self):
+        room1, room2 = self.make_room(1), self.make_room(2)
+        registry = RoomRegistry([room1, room2])
+        self.assertEqual(list(registry), [room1, room2])
+        self.assertIs(registry.get(2), room2)
+        self.assertEqual(registry.find_key(room2.keys[1]), (room2, 1))
+        self.assertEqual(registry.find_key('nonexistent'), (None, None))
+
+    def test_remove(self):
+        room1, room2 = self.make_room(1), self.make_room(2)
+        registry = RoomRegistry([room1, room2])
+        for room in registry:
+            if room.id == 1:
+                registry.remove(room)
+        self.assertEqual(len(registry), 1)
+        self.assertIsNone(registry.get(1))
+        self.assertEqual(registry.find_key(room1.keys[0]), (None, None))
+
+    def test_finished(self):
+        room1, room2 = self.make_room(1), self.make_room(2)
+        room2.aborted = True
+        registry = RoomRegistry([room1, room2])
+        self.assertEqual(registry.finished_rooms(), [room2])
+        room1.aborted = True
+        registry.mark_finished(room1)
+        self.assertEqual(registry.finished_rooms(), [room2, room1])
+        registry.remove(room2)
+        self.assertEqual(registry.finished_rooms(), [room1])
+        # not in the registry
+        registry.mark_finished(self.make_room(3))
+        self.assertEqual(registry.finished_rooms(), [room1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,22 +1,207 @@
 
 import unittest
 import logging
+import json
+from contextlib import contextmanager
+
+import gevent
+import gevent.event
+import gevent.lock
+import gevent.queue
 
 from game import Game
+from protocol import Frame, encode, encode_batch
+from spectator import Spectator
 from utils import make_key
 
 logger = logging.getLogger('room')
 
 
+class RoomLog(object):
+    '''Messages sent to the players, kept for replaying. Messages sent to
+    both players are stored once.'''
+
+    def __init__(self, entries=()):
+        # (to_player, msg_type, msg), to_player is None for both players
+        self.entries = [tuple(entry) for entry in entries]
+        # Number of messages sent to each player
+        self.counts = [0, 0]
+        for to_player, _, _ in self.entries:
+            self.count_entry(to_player)
+
+    def count_entry(self, to_player):
+        if to_player is None:
+            self.counts[0] += 1
+            self.counts[1] += 1
+        else:
+            self.counts[to_player] += 1
+
+    def append(self, to_player, msg_type, msg):
+        self.entries.append((to_player, msg_type, msg))
+        self.count_entry(to_player)
+
+    def messages(self, idx, start=0):
+        '''Messages sent to player idx, skipping the first start.'''
+        result = []
+        n = 0
+        for to_player, msg_type, msg in self.entries:
+            if to_player is None or to_player == idx:
+                if n >= start:
+                    result.append((msg_type, msg))
+                n += 1
+        return result
+
+
 class Room(object):
+    # Games running longer than that (in seconds) are aborted
+    ZOMBIE_TIME = 60*60*1
+
     def __init__(self, nicks=['P1', 'P2'], game_class=Game):
-        self.game = game_class(callback=self.send_to_player)
+        self.game = game_class(callback=self.send_to_player,
+                               broadcast=self.send_to_both)
         self.nicks = nicks
+        # Difficulty levels of bot players, if any
+        self.difficulties = [None, None]
+        # Search progress of bot players, saved with the room
+        self.bot_states = [None, None]
         self.players = [None, None]
-        self.messages = [[], []]
+        # Tenpai suggestions for the players (not saved)
+        self.suggestions = [None, None]
+        # Spectators, receiving only public messages (not saved)
+        self.spectators = []
+        self.log = RoomLog()
         self.keys = self.make_keys()
         self.aborted = False
         self.id = None
+        # Number of the last event recorded in the journal
+        self.journal_seq = 0
+        self.init_journal()
+        self.init_timers()
+        self.init_lock()
+        self.init_actor()
+
+    def init_lock(self):
+        # Held while the game is handling anything: the handler can be
+        # suspended while waiting for game.compute() (not saved)
+        self.lock = gevent.lock.RLock()
+
+    @contextmanager
+    def idle(self):
+        '''Hold the lock if no handler is running (yields True). Doesn't wait
+        for a running handler (yields False), so that the server's beat isn't
+        stalled by one room's computation.'''
+        if not self.lock.acquire(blocking=False):
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            self.lock.release()
+
+    def init_actor(self):
+        # See start_actor() (not saved)
+        self.mailbox = None
+        self.actor = None
+        self.mailbox_peak = 0
+
+    # Actor
+
+    def start_actor(self):
+        '''Process incoming messages and timer wake-ups in the room's own
+        greenlet, one at a time. Without it, they're handled inline.'''
+        self.mailbox = gevent.queue.Queue()
+        self.actor = gevent.spawn(self.run_actor)
+
+    def submit(self, fn, *args, **kwargs):
+        if self.mailbox is None:
+            fn(*args, **kwargs)
+            return
+        self.mailbox.put((fn, args, kwargs))
+        self.mailbox_peak = max(self.mailbox_peak, self.mailbox.qsize())
+
+    @property
+    def mailbox_depth(self):
+        return self.mailbox.qsize() if self.mailbox is not None else 0
+
+    def run_actor(self):
+        mailbox = self.mailbox
+        try:
+            while not self.finished:
+                fn, args, kwargs = mailbox.get()
+                try:
+                    fn(*args, **kwargs)
+                except:
+                    logger.exception('[room %s] exception in actor', self.id)
+        finally:
+            # Anything left is handled inline from now on.
+            self.mailbox = None
+            self.actor = None
+            while not mailbox.empty():
+                fn, args, kwargs = mailbox.get_nowait()
+                fn(*args, **kwargs)
+
+    def receive(self, idx, msg_type, **msg):
+        '''Message from a player, to be handled by the game.'''
+        self.submit(self.send_to_game, idx, msg_type, **msg)
+
+    def wake(self):
+        '''Called when a deadline registered by schedule() expires.'''
+        self.submit(self.beat)
+
+    def init_journal(self):
+        # journal(room, event) is called for every event changing the room
+        # (not saved)
+        self.journal = None
+        self.checkpoint_seq = self.journal_seq
+
+    def init_timers(self):
+        # See set_timers() (not saved)
+        self.timers = None
+        self.clock = None
+        self.synced_at = None
+
+    def set_timers(self, timers, clock):
+        '''Register the game's deadlines in a shared TimerQueue, instead of
+        requiring beat() every second. clock() is the current time in
+        seconds.'''
+        self.timers = timers
+        self.clock = clock
+        self.synced_at = clock()
+        self.schedule()
+
+    def sync(self):
+        '''Bring the game time up to date with the clock.'''
+        if self.clock is None:
+            return
+        with self.lock:
+            self._sync()
+
+    def _sync(self):
+        now = self.clock()
+        elapsed = now - self.synced_at
+        self.synced_at = now
+        if elapsed > 0 and not self.finished:
+            try:
+                self.game.advance(self.game.t + elapsed)
+            except:
+                logger.exception('exception in sync')
+                self.abort()
+                return
+            if self.finished:
+                self.record('timeout')
+
+    def schedule(self):
+        '''Register the time when the room needs to be woken up: the
+        nearest move deadline, or the zombie timeout.'''
+        if self.timers is None:
+            return
+        if self.finished:
+            self.timers.cancel(self)
+            return
+        deadline = self.game.next_deadline()
+        if deadline is None or deadline > self.ZOMBIE_TIME:
+            deadline = self.ZOMBIE_TIME + 1
+        self.timers.schedule(self.synced_at + deadline - self.game.t, self)
 
     def init_from_data(self, data):
         self.game = Game.from_data(data['game'], callback=self.send_to_player)
@@ -27,59 +212,211 @@ class Room(object):
     def start_game(self):
         logger.info('[room %s] starting', self.id)
         self.game.start()
+        self.record('deal')
+        self.schedule()
+
+    # Journal
+
+    # Checkpoint the room after that many events
+    CHECKPOINT_EVENTS = 10
+
+    def record(self, event_type, idx=None, **msg):
+        self.journal_seq += 1
+        if self.journal:
+            self.journal(self, {
+                'seq': self.journal_seq,
+                't': self.game.t,
+                'type': event_type,
+                'player': idx,
+                'msg': msg,
+            })
+        if self.spectators and self.finished:
+            self.release_spectators()
+
+    def replay_event(self, event):
+        '''Apply an event from the journal, when rebuilding the room.'''
+        self.game.advance(event['t'])
+        event_type = event['type']
+        if event_type == 'deal':
+            self.game.start()
+        elif event_type == 'abort':
+            self.aborted = True
+        elif event_type == 'timeout':
+            # already handled by advancing the time
+            pass
+        else:
+            handler = getattr(self.game, 'on_'+event_type)
+            handler(event['player'], **event['msg'])
+        self.journal_seq = self.checkpoint_seq = event['seq']
+
+    def needs_checkpoint(self):
+        pending = self.journal_seq - self.checkpoint_seq
+        if pending >= self.CHECKPOINT_EVENTS or (pending and self.finished):
+            return True
+        # Bots save the progress of their search.
+        return any(hasattr(player, 'checkpoint_pending') and
+                   player.checkpoint_pending()
+                   for player in self.players)
+
+    def has_unsaved_changes(self):
+        '''Whether needs_checkpoint() can become true without new events:
+        there are events since the last checkpoint, or a bot is searching.'''
+        return (self.journal_seq != self.checkpoint_seq or
+                any(getattr(player, 'searching', False)
+                    for player in self.players))
 
     def make_keys(self):
         return (make_key(), make_key())
 
     def send_to_player(self, idx, msg_type, **msg):
-        self.messages[idx].append((msg_type, msg))
+        self.log.append(idx, msg_type, msg)
         if self.players[idx]:
             logger.info('[room %s] send to %d: %s %r', self.id, idx, msg_type, msg)
             self.players[idx].send(msg_type, **msg)
 
+    def send_to_both(self, msg_type, **msg):
+        self.log.append(None, msg_type, msg)
+        if not (self.players[0] or self.players[1] or self.spectators):
+            return
+        logger.info('[room %s] send to both: %s %r', self.id, msg_type, msg)
+        # Players that support it get the same encoded message.
+        frame = Frame(msg_type, msg)
+        for player in self.players:
+            if player is None:
+                continue
+            if hasattr(player, 'send_frame'):
+                player.send_frame(frame)
+            else:
+                player.send(msg_type, **msg)
+        for spectator in self.spectators:
+            spectator.push(frame.encoded)
+
+    def add_spectator(self, spectator):
+        '''Start sending public messages to a Spectator, beginning with the
+        ones sent so far.'''
+        # waits for a move being handled, like add_player()
+        with self.lock:
+            self.spectators = [s for s in self.spectators if not s.dropped]
+            if not self.finished:
+                self.spectators.append(spectator)
+            spectator.push(encode('spectate',
+                                  nicks=self.nicks,
+                                  east=self.game.east,
+                                  dora_ind=self.game.dora_ind))
+            public = [{'type': msg_type, **msg}
+                      for to_player, msg_type, msg in self.log.entries
+                      if to_player is None]
+            if public:
+                spectator.push(encode_batch(public))
+            if self.finished:
+                # nothing more to watch
+                spectator.stop(flush=True)
+
+    def remove_spectator(self, spectator):
+        spectator.stop()
+        if spectator in self.spectators:
+            self.spectators.remove(spectator)
+
+    def release_spectators(self):
+        '''Let the spectators' writers exit after sending what they have
+        queued (the room is not sending anything more).'''
+        for spectator in self.spectators:
+            spectator.stop(flush=True)
+        self.spectators = []
+
     def add_player(self, idx, player, n_received=0):
-        assert not self.players[idx]
-        self.players[idx] = player
-        player.set_room(self, idx)
-        self.replay_messages(idx, n_received)
+        # A handler suspended in compute() holds the lock with the move
+        # half-applied; wait for it, so that the replay sees all of it.
+        with self.lock:
+            assert not self.players[idx]
+            self.players[idx] = player
+            player.set_room(self, idx)
+            self.replay_messages(idx, n_received)
 
     def remove_player(self, idx):
         self.players[idx] = None
 
-    def replay_messages(self, idx, n_received):
-        messages = self.messages[idx]
-        for msg_type, msg in messages[n_received:]:
-            # we don't replay move info, only send the last one to the player
-            if msg_type in ['start_move', 'end_move']:
-                continue
+    # Gaps longer than that are sent as a snapshot of the game state
+    SNAPSHOT_MESSAGES = 10
 
-            logger.info('[room %s] replay to %d: %s %r', self.id, idx, msg_type, msg)
+    # Messages not covered by the snapshot
+    FINAL_MESSAGES = ['ron', 'draw', 'abort']
 
-            self.players[idx].send('replay', msg={'type': msg_type, **msg})
+    def replay_messages(self, idx, n_received):
+        messages = self.log.messages(idx, n_received)
+        if len(messages) > self.SNAPSHOT_MESSAGES:
+            logger.info('[room %s] snapshot to %d (%d messages)',
+                        self.id, idx, len(messages))
+            self.players[idx].send('snapshot', **self.game.snapshot(idx))
+            messages = [(msg_type, msg) for msg_type, msg in messages
+                        if msg_type in self.FINAL_MESSAGES]
+
+        # we don't replay move info, only send the last one to the player
+        batch = [{'type': msg_type, **msg} for msg_type, msg in messages
+                 if msg_type not in ['start_move', 'end_move']]
+        player = self.players[idx]
+        if batch and hasattr(player, 'send_batch'):
+            logger.info('[room %s] replay to %d: %d messages',
+                        self.id, idx, len(batch))
+            player.send_batch(batch)
+        else:
+            for msg in batch:
+                logger.info('[room %s] replay to %d: %r', self.id, idx, msg)
+                player.send('replay', msg=msg)
         self.game.send_move(idx)
 
     def send_to_game(self, idx, msg_type, **msg):
         logger.info('[room %s] receive from %d: %s %r', self.id, idx, msg_type, msg)
-        try:
-            handler = getattr(self.game, 'on_'+msg_type)
-            handler(idx, **msg)
-        except:
-            logger.exception('exception after receiving')
-            self.abort()
+        with self.lock:
+            self.sync()
+            try:
+                handler = getattr(self.game, 'on_'+msg_type)
+                handler(idx, **msg)
+            except:
+                logger.exception('exception after receiving')
+                self.abort()
+            else:
+                self.record(msg_type, idx, **msg)
+            self.schedule()
 
     def beat(self):
-        if self.finished:
-            return
+        with self.idle() as idle:
+            # A running handler calls schedule() when it's done, so
+            # the room will be woken up again if needed.
+            if not idle or self.finished:
+                return
+
+            if self.clock is not None:
+                self.sync()
+            else:
+                try:
+                    self.game.beat()
+                except:
+                    logger.exception('exception in beat')
+                    self.abort()
+                    return
+            # checked here, with the game time up to date
+            if self.zombie:
+                logger.warning('[room %s] aborting zombie room', self.id)
+                self.abort()
+            self.schedule()
 
-        try:
-            self.game.beat()
-        except:
-            logger.exception('exception in beat')
-            self.abort()
+    @property
+    def zombie(self):
+        return not self.finished and self.game.t > self.ZOMBIE_TIME
 
     def abort(self):
-        self.aborted = True
+        with self.lock:
+            self.aborted = True
+            self.record('abort')
+        if self.actor and self.actor is not gevent.getcurrent():
+            # wake it up, so that it notices
+            self.mailbox.put((lambda: None, (), {}))
+        if self.timers is not None:
+            self.timers.cancel(self)
         for idx in range(2):
+            if self.suggestions[idx]:
+                self.suggestions[idx].cancel()
             if self.players[idx]:
                 self.players[idx].shutdown()
 
@@ -90,9 +427,10 @@ class Room(object):
 
 class RoomTest(unittest.TestCase):
     class MockGame(object):
-        def __init__(self, nicks=None, east=None, callback=None):
+        def __init__(self, nicks=None, east=None, callback=None, broadcast=None):
             self.callback = callback
             self.started = False
+            self.t = 0
 
         def start(self):
             assert not self.started
@@ -163,6 +501,51 @@ class RoomTest(unittest.TestCase):
         self.assertEquals(player0.messages[0], ('replay', {'msg': {'type': 'b'}}))
         self.assertEquals(player0.messages[1], ('replay', {'msg': {'type': 'e'}}))
 
+    def test_snapshot_after_connect(self):
+        room = Room()
+        room.start_game()
+        for idx in range(2):
+            hand = list(room.game.initial_tiles[idx][:13])
+            room.send_to_game(idx, 'hand', hand=hand)
+        player = room.game.east
+        for i in range(4):
+            tile = room.game.remaining_tiles(player)[0]
+            room.send_to_game(player, 'discard', tile=tile)
+            player = 1 - player
+
+        player0 = self.MockPlayer()
+        room.add_player(0, player0)
+        msg_types = [msg_type for msg_type, msg in player0.messages]
+        self.assertEqual(msg_types[0], 'snapshot')
+        self.assertNotIn('replay', msg_types)
+        snapshot = player0.messages[0][1]
+        self.assertEqual(snapshot['hand'], room.game.hand[0])
+        self.assertEqual(snapshot['phase'], 2)
+        self.assertEqual(len(snapshot['discards']), 2)
+
+        # short gaps are still replayed
+        player1 = self.MockPlayer()
+        n_received = room.log.counts[1] - 3
+        room.add_player(1, player1, n_received=n_received)
+        self.assertEqual([msg['msg']['type'] for msg_type, msg in player1.messages
+                          if msg_type == 'replay'],
+                         [msg_type for msg_type, msg in room.log.messages(1, n_received)
+                          if msg_type not in ['start_move', 'end_move']])
+
+    def test_replay_batch(self):
+        class BatchPlayer(self.MockPlayer):
+            def send_batch(self, messages):
+                self.messages.append(('replay_batch', messages))
+
+        room = self.create_room()
+        room.game.callback(0, 'a')
+        room.game.callback(0, 'start_move', move_type='hand')
+        room.game.callback(0, 'b', x=1)
+        player0 = BatchPlayer()
+        room.add_player(0, player0)
+        self.assertEqual(player0.messages,
+                         [('replay_batch', [{'type': 'a'}, {'type': 'b', 'x': 1}])])
+
     def test_send_to_game(self):
         player0 = self.MockPlayer()
         player1 = self.MockPlayer()
@@ -179,6 +562,269 @@ class RoomTest(unittest.TestCase):
         self.assertTrue(player0.finished)
         self.assertTrue(player1.finished)
 
+class RoomLogTest(unittest.TestCase):
+    def test_messages(self):
+        log = RoomLog()
+        log.append(0, 'a', {})
+        log.append(None, 'b', {'x': 1})
+        log.append(1, 'c', {})
+        log.append(0, 'd', {})
+        self.assertEqual(log.counts, [3, 2])
+        self.assertEqual(log.messages(0), [('a', {}), ('b', {'x': 1}), ('d', {})])
+        self.assertEqual(log.messages(1, 1), [('c', {})])
+        self.assertEqual(RoomLog(log.entries).counts, log.counts)
+
+    def test_public_stored_once(self):
+        room = Room()
+        room.start_game()
+        for idx in range(2):
+            room.send_to_game(idx, 'hand', hand=list(room.game.initial_tiles[idx][:13]))
+        self.assertEqual([entry[1] for entry in room.log.entries
+                          if entry[0] is None], ['phase_two'])
+
+
+class RoomFrameTest(unittest.TestCase):
+    class FramePlayer(RoomTest.MockPlayer):
+        def send_frame(self, frame):
+            self.messages.append(frame.encoded)
+
+    def test_send_to_both(self):
+        room = Room()
+        players = [self.FramePlayer(), RoomTest.MockPlayer()]
+        room.add_player(0, players[0])
+        room.add_player(1, players[1])
+        room.send_to_both('discarded', player=0, tile='M1')
+        self.assertEqual(json.loads(players[0].messages[-1]),
+                         {'type': 'discarded', 'player': 0, 'tile': 'M1'})
+        self.assertEqual(players[1].messages[-1],
+                         ('discarded', {'player': 0, 'tile': 'M1'}))
+
+    def test_encoded_once(self):
+        room = Room()
+        players = [self.FramePlayer(), self.FramePlayer()]
+        room.add_player(0, players[0])
+        room.add_player(1, players[1])
+        room.send_to_both('draw')
+        self.assertIs(players[0].messages[-1], players[1].messages[-1])
+
+
+class RoomActorTest(unittest.TestCase):
+    def setUp(self):
+        self.room = Room(game_class=RoomTest.MockGame)
+        self.players = [RoomTest.MockPlayer(), RoomTest.MockPlayer()]
+        for idx in range(2):
+            self.room.add_player(idx, self.players[idx])
+        self.room.start_game()
+        self.room.start_actor()
+
+    def test_mailbox(self):
+        self.room.receive(1, 'ping', n=1)
+        self.room.receive(1, 'ping', n=2)
+        self.assertEqual(self.players[0].messages, [])
+        self.assertEqual(self.room.mailbox_depth, 2)
+        gevent.sleep(0)
+        self.assertEqual(self.players[0].messages,
+                         [('pong', {'n': 1}), ('pong', {'n': 2})])
+        self.assertEqual(self.room.mailbox_depth, 0)
+        self.assertEqual(self.room.mailbox_peak, 2)
+
+    def test_stop_when_finished(self):
+        actor = self.room.actor
+        self.room.receive(0, 'crash')
+        actor.join(timeout=1)
+        self.assertTrue(actor.dead)
+        self.assertIsNone(self.room.mailbox)
+        # handled inline now
+        self.room.receive(1, 'ping')
+        self.assertEqual(self.players[0].messages[-1][0], 'pong')
+
+    def test_abort(self):
+        actor = self.room.actor
+        self.room.abort()
+        actor.join(timeout=1)
+        self.assertTrue(actor.dead)
+
+
+class RoomSpectatorTest(unittest.TestCase):
+    def test_public_messages(self):
+        sent = []
+        room = Room()
+        room.start_game()
+        room.send_to_game(0, 'hand', hand=list(room.game.initial_tiles[0][:13]))
+        spectator = Spectator(sent.append, lambda: None)
+        room.add_spectator(spectator)
+        room.send_to_game(1, 'hand', hand=list(room.game.initial_tiles[1][:13]))
+        room.send_to_both('draw')
+        gevent.sleep(0)
+        msgs = [json.loads(data) for data in sent]
+        self.assertEqual([msg['type'] for msg in msgs],
+                         ['spectate', 'phase_two', 'draw'])
+        self.assertEqual(msgs[0]['nicks'], room.nicks)
+
+        room.remove_spectator(spectator)
+        gevent.sleep(0)
+        self.assertTrue(spectator.thread.dead)
+
+    def test_finished(self):
+        sent = []
+        room = Room()
+        room.start_game()
+        spectator = Spectator(sent.append, lambda: None)
+        room.add_spectator(spectator)
+        room.abort()
+        self.assertEqual(room.spectators, [])
+        gevent.sleep(0)
+        self.assertTrue(spectator.thread.dead)
+
+        # watching a finished room sends what happened, and stops
+        late = Spectator(sent.append, lambda: None)
+        room.add_spectator(late)
+        self.assertEqual(room.spectators, [])
+        gevent.sleep(0)
+        self.assertTrue(late.thread.dead)
+        self.assertEqual(json.loads(sent[-1])['type'], 'spectate')
+
+    def test_slow_spectator(self):
+        blocked = gevent.event.Event()
+        room = Room()
+        player = RoomTest.MockPlayer()
+        room.add_player(0, player)
+        spectator = Spectator(lambda data: blocked.wait(), lambda: None)
+        room.add_spectator(spectator)
+        for i in range(Spectator.QUEUE_SIZE + 1):
+            room.send_to_both('ping', n=i)
+        self.assertTrue(spectator.dropped)
+        self.assertEqual(len(player.messages), Spectator.QUEUE_SIZE + 1)
+
+
+class RoomLockTest(unittest.TestCase):
+    def test_suspended_handler(self):
+        def slow_compute(fn, *args):
+            gevent.sleep(0.01)
+            return fn(*args)
+
+        room = Room()
+        room.game.compute = slow_compute
+        room.start_game()
+        hands = [list(room.game.initial_tiles[i][:13]) for i in range(2)]
+        threads = [gevent.spawn(room.send_to_game, i, 'hand', hand=hands[i])
+                   for i in range(2)]
+        gevent.joinall(threads)
+        self.assertFalse(room.finished)
+        self.assertEqual(room.game.phase, 2)
+        for idx in range(2):
+            msg_types = [msg_type for msg_type, msg in room.log.messages(idx)]
+            self.assertEqual(msg_types.count('phase_two'), 1)
+            self.assertLess(msg_types.index('hand'), msg_types.index('phase_two'))
+
+    def test_add_player_during_handler(self):
+        def slow_compute(fn, *args):
+            gevent.sleep(0.01)
+            return fn(*args)
+
+        room = Room()
+        room.game.compute = slow_compute
+        room.start_game()
+        hand = list(room.game.initial_tiles[0][:13])
+        thread = gevent.spawn(room.send_to_game, 0, 'hand', hand=hand)
+        gevent.sleep(0)
+        player = RoomTest.MockPlayer()
+        room.add_player(0, player)
+        self.assertTrue(thread.dead)
+        msg_types = [msg['msg']['type'] for msg_type, msg in player.messages
+                     if msg_type == 'replay']
+        self.assertIn('hand', msg_types)
+        # the hand move is over, not requested again
+        self.assertNotIn('start_move', [msg_type for msg_type, msg in player.messages])
+
+    def test_idle(self):
+        def slow_compute(fn, *args):
+            gevent.sleep(0.01)
+            return fn(*args)
+
+        room = Room()
+        room.game.compute = slow_compute
+        room.start_game()
+        hand = list(room.game.initial_tiles[0][:13])
+        thread = gevent.spawn(room.send_to_game, 0, 'hand', hand=hand)
+        gevent.sleep(0)
+        with room.idle() as idle:
+            self.assertFalse(idle)
+        thread.join()
+        with room.idle() as idle:
+            self.assertTrue(idle)
+
+
+class RoomJournalTest(unittest.TestCase):
+    def test_record(self):
+        events = []
+        room = Room()
+        room.journal = lambda room, event: events.append(event)
+        room.start_game()
+        hand = list(room.game.initial_tiles[0][:13])
+        room.send_to_game(0, 'hand', hand=hand)
+        room.abort()
+        self.assertEqual([e['type'] for e in events], ['deal', 'hand', 'abort'])
+        self.assertEqual(events[1]['player'], 0)
+        self.assertEqual(events[1]['msg'], {'hand': hand})
+        self.assertEqual([e['seq'] for e in events], [1, 2, 3])
+        self.assertTrue(room.needs_checkpoint())
+
+    def test_unsaved_changes(self):
+        room = Room()
+        self.assertFalse(room.has_unsaved_changes())
+        room.start_game()
+        self.assertTrue(room.has_unsaved_changes())
+        room.checkpoint_seq = room.journal_seq
+        self.assertFalse(room.has_unsaved_changes())
+
+        # a bot's search, saved with the room
+        bot = RoomTest.MockPlayer()
+        bot.searching = True
+        room.add_player(0, bot)
+        self.assertTrue(room.has_unsaved_changes())
+
+
+class RoomTimersTest(unittest.TestCase):
+    def setUp(self):
+        from timers import TimerQueue
+
+        self.now = 100
+        self.timers = TimerQueue()
+        self.room = Room()
+        self.room.set_timers(self.timers, lambda: self.now)
+        self.room.start_game()
+
+    def test_hand_deadline(self):
+        deadline = 100 + Game.HAND_TIME_LIMIT + Game.EXTRA_TIME
+        self.assertEqual(self.timers.pop_expired(deadline - 1), [])
+        self.now = deadline
+        self.assertEqual(self.timers.pop_expired(self.now), [self.room])
+        self.room.beat()
+        self.assertTrue(self.room.finished)
+        self.assertEqual(self.room.game.t, deadline - 100)
+        self.assertEqual(len(self.timers), 0)
+
+    def test_sync_before_move(self):
+        self.now = 150
+        hand = list(self.room.game.initial_tiles[0][:13])
+        self.room.send_to_game(0, 'hand', hand=hand)
+        self.assertEqual(self.room.game.t, 50)
+        # player 1 still has the original deadline
+        deadline = 100 + Game.HAND_TIME_LIMIT + Game.EXTRA_TIME
+        self.assertEqual(self.timers.pop_expired(deadline), [self.room])
+
+    def test_zombie(self):
+        game = self.room.game
+        game.moves = [None, None]
+        self.room.schedule()
+        self.now = 100 + Room.ZOMBIE_TIME + 1
+        self.assertEqual(self.timers.pop_expired(self.now), [self.room])
+        self.room.beat()
+        self.assertTrue(self.room.aborted)
+        self.assertEqual(len(self.timers), 0)
+
+
 if __name__ == '__main__':
     #logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(name)s: %(message)s')
     unittest.main()
@@ -13,6 +13,9 @@ import functools
 ALL_TILES = ['%s%s' % (suit, no) for suit in 'MPSX' for no in range(1,10)
     if suit != 'X' or no <= 7]
 
+# Position of a tile in ALL_TILES, for compact representations
+TILE_INDEX = {tile: i for i, tile in enumerate(ALL_TILES)}
+
 TERMINALS = {suit + no for suit in 'MPS' for no in '19'}
 
 WINDS = {'X' + no for no in '1234'}
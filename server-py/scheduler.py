@@ -0,0 +1,217 @@
+
+import heapq
+import itertools
+import logging
+import unittest
+
+import gevent
+
+from clock import RealClock, VirtualClock
+
+logger = logging.getLogger('scheduler')
+
+
+class Job(object):
+    def __init__(self, deadline, run, priority=0):
+        self.deadline = deadline
+        self.run = run
+        self.priority = priority
+        self.thread = None
+        self.timer = None
+        self.cancelled = False
+        self.finished = False
+
+    @property
+    def started(self):
+        return self.thread is not None
+
+
+class BotScheduler(object):
+    '''Runs bot searches, earliest deadline first.
+
+    At most max_running searches run at the same time; the rest wait in a
+    queue. Each search gets the time left until its deadline, shared with
+    the other searches competing for the CPU: with no competition, it can
+    use all of it.
+
+    A bot search still waiting close to its deadline is started anyway,
+    even over the limit (see expire()): a bot that doesn't answer loses the
+    game by timeout, which is worse than a short CPU overload.
+
+    Low priority jobs (tenpai suggestions) run only when no bot search is
+    waiting, and are never started over the limit.
+    '''
+
+    PRIORITY_BOT = 0
+    PRIORITY_LOW = 1
+
+    # Time reserved for sending the result, in seconds
+    SAFETY_MARGIN = 5
+    # A job that has waited too long is started anyway, with this budget
+    MIN_BUDGET = 1
+
+    def __init__(self, max_running=2, clock=None):
+        self.max_running = max_running
+        self.clock = clock or RealClock()
+        self.queue = []
+        self.running = 0
+        self.counter = itertools.count()
+
+    def submit(self, time_left, run, priority=PRIORITY_BOT):
+        '''Schedule run(time_budget), which has to finish within time_left
+        seconds from now.'''
+
+        job = Job(self.clock.now() + time_left, run, priority)
+        heapq.heappush(self.queue,
+                       (priority, job.deadline, next(self.counter), job))
+        if priority == self.PRIORITY_BOT:
+            # Don't let the job starve in the queue.
+            delay = time_left - self.SAFETY_MARGIN - self.MIN_BUDGET
+            job.timer = self.clock.spawn_later(max(0, delay), self.expire, job)
+        self.dispatch()
+        return job
+
+    def cancel(self, job):
+        job.cancelled = True
+        if job.timer:
+            job.timer.kill()
+        if job.thread and job.thread is not gevent.getcurrent():
+            job.thread.kill()
+            # a greenlet killed before it ran never gets to run_job's
+            # finally, so free its slot here
+            self.finish(job)
+
+    def dispatch(self):
+        while self.queue and self.running < self.max_running:
+            _, _, _, job = heapq.heappop(self.queue)
+            if not (job.cancelled or job.started):
+                self.start(job)
+
+    def expire(self, job):
+        # (can go over max_running, see the class docstring)
+        if not (job.cancelled or job.started):
+            logger.warning('starting a search over the limit (%d running)',
+                           self.running)
+            self.start(job)
+
+    def start(self, job):
+        if job.timer and job.timer is not gevent.getcurrent():
+            job.timer.kill()
+        self.running += 1
+        job.thread = gevent.spawn(self.run_job, job, self.time_budget(job))
+
+    def waiting(self, exclude=None):
+        # the queue can still hold cancelled jobs, and the ones started by
+        # expire()
+        return sum(1 for _, _, _, job in self.queue
+                   if not (job.cancelled or job.started or job is exclude))
+
+    def time_budget(self, job):
+        '''Time for a job being started (already counted as running).'''
+        load = self.running + self.waiting(exclude=job)
+        time_left = max(0, job.deadline - self.clock.now() - self.SAFETY_MARGIN)
+        share = time_left * self.max_running / max(self.max_running, load)
+        return max(share, min(self.MIN_BUDGET, time_left))
+
+    def run_job(self, job, time_budget):
+        try:
+            job.run(time_budget)
+        finally:
+            self.finish(job)
+
+    def finish(self, job):
+        if not job.finished:
+            job.finished = True
+            self.running -= 1
+            self.dispatch()
+
+
+class BotSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = BotScheduler(max_running=1)
+        self.budgets = []
+
+    def make_run(self, name, duration=0):
+        def run(time_budget):
+            self.budgets.append((name, time_budget))
+            gevent.sleep(duration)
+        return run
+
+    def test_earliest_deadline_first(self):
+        self.scheduler.submit(100, self.make_run('a', 0.01))
+        self.scheduler.submit(100, self.make_run('late'))
+        self.scheduler.submit(50, self.make_run('early'))
+        gevent.sleep(0.05)
+        self.assertEqual([name for name, _ in self.budgets],
+                         ['a', 'early', 'late'])
+        self.assertEqual(self.scheduler.running, 0)
+
+    def test_budget_shrinks_under_load(self):
+        clock = VirtualClock()
+        scheduler = BotScheduler(max_running=2, clock=clock)
+        time_left = 1000 - BotScheduler.SAFETY_MARGIN
+        # no load: the whole time until the deadline
+        self.assertEqual(scheduler.time_budget(Job(1000, None)), time_left)
+        scheduler.running = 2
+        jobs = [scheduler.submit(1000, None) for i in range(2)]
+        self.assertEqual(scheduler.time_budget(Job(1000, None)), time_left / 2)
+        # cancelled jobs don't count
+        for job in jobs:
+            scheduler.cancel(job)
+        self.assertEqual(scheduler.time_budget(Job(1000, None)), time_left)
+
+    def test_budget_within_deadline(self):
+        self.scheduler.submit(20, self.make_run('a'))
+        gevent.sleep(0)
+        (name, budget), = self.budgets
+        self.assertLessEqual(budget, 20 - BotScheduler.SAFETY_MARGIN)
+
+    def test_expire(self):
+        self.scheduler.submit(100, self.make_run('slow', 0.1))
+        self.scheduler.submit(BotScheduler.SAFETY_MARGIN + BotScheduler.MIN_BUDGET,
+                              self.make_run('urgent'))
+        gevent.sleep(0.01)
+        self.assertEqual([name for name, _ in self.budgets], ['slow', 'urgent'])
+
+    def test_expire_virtual_clock(self):
+        clock = VirtualClock()
+        scheduler = BotScheduler(max_running=1, clock=clock)
+        scheduler.submit(1000, self.make_run('slow', 0.1))
+        scheduler.submit(100, self.make_run('urgent'))
+        gevent.sleep(0)
+        self.assertEqual([name for name, _ in self.budgets], ['slow'])
+        clock.sleep(100 - BotScheduler.SAFETY_MARGIN - BotScheduler.MIN_BUDGET)
+        gevent.sleep(0)
+        self.assertEqual(self.budgets[1], ('urgent', BotScheduler.MIN_BUDGET))
+
+    def test_cancel(self):
+        self.scheduler.submit(100, self.make_run('a', 0.01))
+        job = self.scheduler.submit(100, self.make_run('b'))
+        self.scheduler.cancel(job)
+        gevent.sleep(0.05)
+        self.assertEqual([name for name, _ in self.budgets], ['a'])
+
+    def test_cancel_before_running(self):
+        # started, but its greenlet hasn't run yet
+        job = self.scheduler.submit(100, self.make_run('a'))
+        self.assertTrue(job.started)
+        self.scheduler.cancel(job)
+        self.scheduler.cancel(job)
+        self.assertEqual(self.scheduler.running, 0)
+        self.scheduler.submit(100, self.make_run('b'))
+        gevent.sleep(0.01)
+        self.assertEqual([name for name, _ in self.budgets], ['b'])
+        self.assertEqual(self.scheduler.running, 0)
+
+    def test_low_priority(self):
+        self.scheduler.submit(100, self.make_run('a', 0.01))
+        self.scheduler.submit(10, self.make_run('suggestion'),
+                              priority=BotScheduler.PRIORITY_LOW)
+        self.scheduler.submit(100, self.make_run('bot'))
+        gevent.sleep(0.05)
+        self.assertEqual([name for name, _ in self.budgets],
+                         ['a', 'bot', 'suggestion'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,91 +9,286 @@ import signal
 import sys
 import os
 import functools
-from datetime import datetime
 import unittest
+import unittest.mock
 import json
 
 import gevent
 from gevent import pywsgi
+from gevent.server import StreamServer
 from geventwebsocket.handler import WebSocketHandler
 # TODO relative imports
 from websocketagent import WebSocketAgent
 
 from room import Room
+from registry import RoomRegistry
+from game import Game
 from database import Database
 from logs import init_logging
-from utils import make_key
-from bot_player import BotPlayer
+from utils import make_key, key_shard
+from bot_player import BotPlayer, Suggestions, search_summary, DIFFICULTIES, DEFAULT_DIFFICULTY
+from scheduler import BotScheduler
+from timers import TimerQueue
+from compute import inline, ThreadCompute
+from clock import RealClock, VirtualClock
+from protocol import encode, encode_batch
+from spectator import Spectator
+from lobby import Lobby
+from shard import (Shards, InternalAgent, ShardProxy, LobbyMirror,
+                   follow_lobby, reuse_port_listener, run_workers)
 
 logger = logging.getLogger('server')
 
 
 class GameServer(object):
-    def __init__(self, fname, use_bots=False):
+    # How often to log bot search statistics, in seconds
+    BOT_STATS_INTERVAL = 10*60
+    # How often to log room mailbox statistics, in seconds
+    MAILBOX_STATS_INTERVAL = 10*60
+
+    def __init__(self, fname, use_bots=False, compute=inline, clock=None,
+                 use_actors=False, shards=None):
         self.waiting_players = {}
+        # Worker's share of the rooms, when running several (see shard.py)
+        self.shards = shards
+        self.internal_server = None
+        self.lobby_followers = []
+        # Run every room in its own greenlet (see Room.start_actor)
+        self.use_actors = use_actors
+        # Source of time for the beat timer and the bot scheduler
+        self.clock = clock or RealClock()
+        # Runs rules computations for all games (see compute.py)
+        self.compute = compute
         self.db = Database(fname)
-        self.rooms = self.db.load_unfinished_rooms()
+        # Games and waiting players, pushed to subscribed connections
+        self.lobby = Lobby()
+        if shards:
+            # This worker's part of the lobby, copied to every worker's lobby
+            self.local_lobby = Lobby()
+            self.local_lobby.subscribe(LobbyMirror(self.lobby))
+        else:
+            self.local_lobby = self.lobby
+        self.rooms = RoomRegistry(self.db.load_unfinished_rooms())
+        # Rooms that can need a checkpoint (see checkpoint_rooms)
+        self.dirty_rooms = set()
         self.t = 0
         self.timer = None
+        # Rooms are woken up only when one of their deadlines expires
+        self.room_timers = TimerQueue()
+        for room in self.rooms:
+            self.attach_room(room)
         self.use_bots = use_bots
+        # Shared by all bots, so that a burst of games (e.g. after restart)
+        # doesn't make the searches miss their deadlines.
+        self.bot_scheduler = BotScheduler(clock=self.clock)
 
         if use_bots:
             for room in self.rooms:
                 for i, nick in enumerate(room.nicks):
                     # XXX recognize bots in a nicer way
                     if nick == 'Bot':
-                        bot = BotPlayer()
+                        difficulty = room.difficulties[i] or DEFAULT_DIFFICULTY
+                        bot = BotPlayer(scheduler=self.bot_scheduler,
+                                        difficulty=difficulty,
+                                        search_state=room.bot_states[i])
                         room.add_player(i, bot)
 
+    def attach_room(self, room):
+        room.set_timers(self.room_timers, lambda: self.t)
+        room.journal = self.on_room_event
+        room.game.compute = self.compute
+        self.dirty_rooms.add(room)
+        if self.use_actors:
+            room.start_actor()
+        if not room.finished:
+            room_ref = self.room_ref(room)
+            self.local_lobby.set('game:%d' % room_ref,
+                                 {'type': 'game', 'nicks': room.nicks, 'id': room_ref})
+
+    def on_room_event(self, room, event):
+        self.db.append_event(room, event)
+        self.dirty_rooms.add(room)
+        if room.finished:
+            self.local_lobby.remove('game:%d' % self.room_ref(room))
+            # evicted once the players leave (see evict_rooms)
+            self.rooms.mark_finished(room)
+
+    # Sharding
+
+    def make_key(self):
+        if self.shards:
+            return make_key(shard=(self.shards.index, self.shards.count))
+        return make_key()
+
+    def key_shard(self, key):
+        return key_shard(key, self.shards.count) if self.shards else 0
+
+    def room_ref(self, room):
+        '''Room ID as seen by the clients, unique across the workers.'''
+        if self.shards:
+            return room.id * self.shards.count + self.shards.index
+        return room.id
+
+    def room_ref_shard(self, room_ref):
+        return room_ref % self.shards.count if self.shards else 0
+
+    def hand_off(self, player, shard, msg_type, **msg):
+        '''If the request belongs to another worker, forward the player's
+        connection there and return True.'''
+        if not self.shards or shard == self.shards.index:
+            return False
+        subscribed = player in self.lobby.subscribers
+        self.remove_player(player)
+        agent = player.agent
+        try:
+            agent.proxy = ShardProxy(self.shards.addresses[shard],
+                                     agent.send, agent.disconnect)
+        except OSError:
+            logger.exception('cannot reach worker %d', shard)
+            player.shutdown()
+            return True
+        if subscribed:
+            # The other worker's lobby takes over (and keeps sending updates
+            # if the request fails).
+            agent.proxy.send(encode('subscribe_games'))
+        agent.proxy.send(encode(msg_type, **msg))
+        return True
+
+    def start_shard(self):
+        '''Accept connections from other workers, and follow their
+        lobbies.'''
+        self.internal_server = StreamServer(
+            self.shards.addresses[self.shards.index], self.serve_internal)
+        self.internal_server.start()
+        self.lobby_followers = [
+            gevent.spawn(follow_lobby, address, self.lobby)
+            for i, address in enumerate(self.shards.addresses)
+            if i != self.shards.index]
+
+    def stop_shard(self):
+        gevent.killall(self.lobby_followers)
+        self.lobby_followers = []
+        if self.internal_server:
+            self.internal_server.stop()
+            self.internal_server = None
+
+    def serve_internal(self, sock, address):
+        player = SocketPlayer(self, InternalAgent(sock))
+        try:
+            for line in sock.makefile('rb'):
+                dispatch_message(player, line)
+        except OSError:
+            # the other worker went away, or we are stopping
+            pass
+        except Exception:
+            logger.exception('error in internal connection')
+        finally:
+            player.recv_disconnect()
+
     def add_player(self, player):
         '''Adds a player to the server.'''
 
         self.waiting_players[player.key] = player
-        return
+        item = {
+            'type': 'player',
+            'nick': player.nick,
+            'key': player.key,
+        }
+        if isinstance(player, BotPlayer):
+            item['difficulty'] = player.difficulty
+        self.local_lobby.set('player:' + player.key, item)
 
     def join_player(self, player, key):
         if key in self.waiting_players:
             opponent = self.waiting_players.pop(key)
+            self.lobby.unsubscribe(opponent)
+            self.lobby.unsubscribe(player)
+            self.local_lobby.remove('player:' + key)
             room = Room([opponent.nick, player.nick])
-            self.rooms.append(room)
+            room.keys = (self.make_key(), self.make_key())
+            room.difficulties = [getattr(opponent, 'difficulty', None),
+                                 getattr(player, 'difficulty', None)]
+            # save to database, to assign ID before the first event
+            self.db.save_room(room)
+            self.rooms.add(room)
+            self.attach_room(room)
             room.add_player(0, opponent)
             room.add_player(1, player)
             room.start_game()
-            # save to database, to assign ID
-            self.db.save_room(room)
         else:
             player.send('join_failed', description='Opponent not found.')
 
     def rejoin_player(self, player, key):
-        for room in self.rooms:
-            for idx in range(2):
-                if room.keys[idx] == key:
-                    if room.players[idx]:
-                        old_player = room.players[idx]
-                        self.remove_player(old_player)
-                        old_player.shutdown()
-                    room.add_player(idx, player)
+        room, idx = self.rooms.find_key(key)
+        if room is None:
+            return
+        self.lobby.unsubscribe(player)
+        # (a reentrant lock, taken by add_player() as well)
+        with room.lock:
+            if room.players[idx]:
+                old_player = room.players[idx]
+                self.remove_player(old_player)
+                old_player.shutdown()
+            room.add_player(idx, player)
+
+    def spectate(self, player, room_ref):
+        room = self.rooms.get(room_ref // self.shards.count
+                              if self.shards else room_ref)
+        if room is None:
+            player.send('spectate_failed', description='Game not found.')
+            return
+        self.lobby.unsubscribe(player)
+        player.spectating = room
+        player.spectator = Spectator(player.send_data, player.shutdown)
+        room.add_spectator(player.spectator)
 
     def remove_player(self, player):
+        if getattr(player, 'spectating', None):
+            player.spectating.remove_spectator(player.spectator)
+            player.spectating = None
+        self.lobby.unsubscribe(player)
+        self.local_lobby.unsubscribe(player)
         if player.key in self.waiting_players:
             del self.waiting_players[player.key]
-        elif player.room:
+            self.local_lobby.remove('player:' + player.key)
+        elif player.room and player.room.players[player.idx] is player:
+            # (the seat might be taken by a rejoined player already)
             player.room.remove_player(player.idx)
         else:
             pass
 
+    def suggest(self, player, k):
+        '''Send the player up to k best tenpai hands for their tiles.'''
+
+        room = player.room
+        idx = player.idx
+        if not room:
+            player.send('suggestions', hands=[])
+            return
+
+        k = max(1, min(k, Suggestions.MAX_HANDS))
+        # waits for a move being handled, so that we don't see it half-applied
+        with room.lock:
+            if room.finished or room.game.hand[idx] is not None:
+                player.send('suggestions', hands=[])
+                return
+            if not room.suggestions[idx]:
+                game = room.game
+                options = game.options(idx)
+                room.suggestions[idx] = Suggestions(
+                    list(game.initial_tiles[idx]),
+                    {'dora_ind': options['dora_ind'],
+                     'fanpai_winds': options['fanpai_winds']},
+                    scheduler=self.bot_scheduler)
+
+        def send(hands):
+            # the player might have left in the meantime
+            if player.room is room and room.players[idx] is player:
+                player.send('suggestions', hands=hands[:k])
+        room.suggestions[idx].request(send)
+
     def describe_games(self):
-        result = []
-        for room in self.rooms:
-            if not room.finished:
-                result.append({'type': 'game', 'nicks': room.nicks})
-        for player in self.waiting_players.values():
-            result.append({
-                'type': 'player',
-                'nick': player.nick,
-                'key': player.key,
-            })
-        return result
+        return self.lobby.games()
 
     def serve_request(self, environ, start_response):
         path = environ['PATH_INFO'].strip('/')
@@ -117,79 +312,145 @@ class GameServer(object):
 
     def serve(self, host, port, debug):
         self.debug = debug
+        listener = (host, port)
+        if self.shards:
+            listener = reuse_port_listener(host, port)
+            self.start_shard()
         if debug:
             import static
             static_path = os.path.join(os.path.dirname(__file__), '..', 'client', 'static')
             self.static_app = static.Cling(static_path)
         self.wsgi_server = pywsgi.WSGIServer(
-            (host, port),
+            listener,
             self.serve_request,
             handler_class=WebSocketHandler)
-        self.timer = Timer(self.beat)
+        self.start_timer()
         self.wsgi_server.serve_forever()
 
+    def start_timer(self):
+        self.timer = Timer(self.beat, self.clock)
+
     def stop(self, immediate=False):
         logger.info('stopping')
         if not immediate:
             if self.timer:
                 self.timer.stop()
+        self.stop_shard()
         self.save_rooms()
         if hasattr(self, 'socketio_server'):
             self.socketio_server.stop()
 
-    def add_bot(self):
-        if not any(isinstance(player, BotPlayer)
+    def add_bot(self, difficulty=DEFAULT_DIFFICULTY):
+        if not any(isinstance(player, BotPlayer) and
+                   player.difficulty == difficulty
                    for player in self.waiting_players.values()):
-            logger.info('adding a bot')
-            bot = BotPlayer()
+            logger.info('adding a bot (%s)', difficulty)
+            bot = BotPlayer(scheduler=self.bot_scheduler,
+                            difficulty=difficulty)
+            bot.key = self.make_key()
             self.add_player(bot)
 
+    def add_bots(self):
+        '''Make sure there's a bot of every difficulty waiting for a game.'''
+        for difficulty in DIFFICULTIES:
+            self.add_bot(difficulty)
+
     def beat(self):
         logger.debug('beat')
         self.t += 1
         if self.t % (60*60*3) == 0:
             logger.info('beat t = %d', self.t)
 
-        for room in self.rooms:
-            room.beat()
+        for room in self.room_timers.pop_expired(self.t):
+            # (the room aborts itself if it runs for too long)
+            room.wake()
         if self.use_bots:
-            self.add_bot()
+            self.add_bots()
+            if self.t % self.BOT_STATS_INTERVAL == 0:
+                search_summary.log()
+        if self.use_actors and self.t % self.MAILBOX_STATS_INTERVAL == 0:
+            self.log_mailbox_stats()
 
         if self.t % 30 == 0:
-            self.save_rooms()
-            for room in list(self.rooms):
-                if not (room.players[0] or room.players[1]):
-                    if room.finished:
-                        logger.info('removing inactive room %s from memory', room.id)
-                        self.rooms.remove(room)
-                if not room.finished and room.game.t > 60*60*1:
-                    logger.warning('aborting zombie room', room.id)
-                    room.abort()
-                    self.db.save_room(room)
+            self.checkpoint_rooms()
+            self.evict_rooms()
 
         if self.t % (60*60*3) == 0:
             logger.info('end beat t = %d', self.t)
 
+    def log_mailbox_stats(self):
+        depths = [(room.mailbox_depth, room.mailbox_peak, room.id)
+                  for room in self.rooms if room.actor]
+        if not depths:
+            return
+        logger.info('room mailboxes: %d actors, %d queued, max depth %d, '
+                    'max peak %d (room %s)',
+                    len(depths), sum(d for d, _, _ in depths),
+                    max(d for d, _, _ in depths),
+                    *max((peak, id) for _, peak, id in depths))
+        for room in self.rooms:
+            room.mailbox_peak = room.mailbox_depth
+
     def save_rooms(self):
         logger.debug('saving %d rooms', len(self.rooms))
         for room in self.rooms:
-            self.db.save_room(room)
+            # (when stopping, we wait for the running handlers to finish)
+            with room.lock:
+                room.sync()
+                self.db.save_room(room)
+
+    def checkpoint_rooms(self):
+        '''Save the rooms that have enough events journaled since their last
+        checkpoint. Rooms in the middle of handling a move are skipped (and
+        saved next time).
+
+        Only the rooms changed since their last checkpoint are checked, not
+        the idle ones.'''
+        n_checked = len(self.dirty_rooms)
+        n_saved = n_busy = 0
+        for room in list(self.dirty_rooms):
+            if room.needs_checkpoint():
+                with room.idle() as idle:
+                    if not idle:
+                        n_busy += 1
+                        continue
+                    room.sync()
+                    self.db.save_room(room)
+                    n_saved += 1
+            if not room.has_unsaved_changes():
+                self.dirty_rooms.discard(room)
+        logger.debug('checkpointed %d/%d rooms (%d busy)',
+                     n_saved, n_checked, n_busy)
+
+    def evict_rooms(self):
+        '''Remove finished rooms from memory once their players have left.'''
+        for room in self.rooms.finished_rooms():
+            if room.players[0] or room.players[1]:
+                continue
+            if room.needs_checkpoint():
+                # busy during checkpoint_rooms(), not saved yet
+                continue
+            logger.info('removing inactive room %s from memory', room.id)
+            room.release_spectators()
+            self.rooms.remove(room)
+            self.dirty_rooms.discard(room)
 
 
 class Timer(object):
     SLEEP_INTERVAL = 0.2
 
-    def __init__(self, beat):
+    def __init__(self, beat, clock=None):
         self.beat = beat
+        self.clock = clock or RealClock()
         self.thread = gevent.spawn(self.run)
 
     def run(self):
-        start = datetime.now()
+        start = self.clock.now()
         t = 0
         while True:
-            new_t = int((datetime.now() - start).seconds)
+            new_t = int(self.clock.now() - start)
             if t >= new_t:
-                gevent.sleep(self.SLEEP_INTERVAL)
+                self.clock.sleep(self.SLEEP_INTERVAL)
             else:
                 t += 1
                 try:
@@ -207,21 +468,30 @@ class MinefieldAgent(WebSocketAgent):
 
     def on_connect(self):
         self.player = SocketPlayer(self.server, self)
+        # Connection to the worker the player was handed off to, if any
+        self.proxy = None
 
     def on_message(self, message):
-        data = json.loads(message)
-        msg_type = data.pop('type')
-        method = getattr(self.player, 'on_' + msg_type, None)
-        if method:
-            method(**data)
+        if self.proxy:
+            self.proxy.send(message)
+        else:
+            dispatch_message(self.player, message)
 
     def on_disconnect(self, error):
+        if self.proxy:
+            self.proxy.close()
         self.player.recv_disconnect()
 
     def emit(self, msg_type, **msg_args):
-        data = {'type': msg_type, **msg_args}
-        message = json.dumps(data)
-        self.send(message)
+        self.send(encode(msg_type, **msg_args))
+
+
+def dispatch_message(player, message):
+    data = json.loads(message)
+    msg_type = data.pop('type')
+    method = getattr(player, 'on_' + msg_type, None)
+    if method:
+        method(**data)
 
 
 class SocketPlayer(object):
@@ -231,7 +501,10 @@ class SocketPlayer(object):
         self.nick = None
         self.room = None
         self.idx = None
-        self.key = make_key()
+        self.key = server.make_key()
+        # Room watched as a spectator, if any
+        self.spectating = None
+        self.spectator = None
 
     def on_new_game(self, *, nick):
         assert not self.room
@@ -247,14 +520,45 @@ class SocketPlayer(object):
 
     def on_join(self, *, nick, key):
         assert not self.room
+        if self.server.hand_off(self, self.server.key_shard(key),
+                                'join', nick=nick, key=key):
+            return
         self.nick = nick
         self.server.join_player(self, key)
 
     def on_rejoin(self, *, key):
+        if self.server.hand_off(self, self.server.key_shard(key),
+                                'rejoin', key=key):
+            return
         self.server.rejoin_player(self, key)
 
+    def on_spectate(self, *, room_id):
+        assert not self.room
+        if self.server.hand_off(self, self.server.room_ref_shard(room_id),
+                                'spectate', room_id=room_id):
+            return
+        self.server.spectate(self, room_id)
+
+    def on_suggest(self, *, k=3):
+        if not isinstance(k, int) or isinstance(k, bool):
+            logger.warning('[suggest] invalid k: %r', k)
+            self.send('suggestions', hands=[])
+            return
+        self.server.suggest(self, k)
+
     def on_get_games(self):
-        self.send('games', games=self.server.describe_games())
+        # kept for older clients, see on_subscribe_games
+        self.send_data(self.server.lobby.payload)
+
+    def on_subscribe_games(self):
+        if self.room:
+            # e.g. sent by the client right after rejoining
+            return
+        self.server.lobby.subscribe(self)
+
+    def on_subscribe_shard(self):
+        # another worker following this one's part of the lobby
+        self.server.local_lobby.subscribe(self)
 
     def set_room(self, room, idx):
         self.room = room
@@ -269,10 +573,10 @@ class SocketPlayer(object):
         self.shutdown()
 
     def on_hand(self, **msg):
-        self.room.send_to_game(self.idx, 'hand', **msg)
+        self.room.receive(self.idx, 'hand', **msg)
 
     def on_discard(self, **msg):
-        self.room.send_to_game(self.idx, 'discard', **msg)
+        self.room.receive(self.idx, 'discard', **msg)
 
     def on_boom(self):
         raise Exception("'boom' received")
@@ -280,6 +584,16 @@ class SocketPlayer(object):
     def send(self, msg_type, **msg):
         self.agent.emit(msg_type, **msg)
 
+    def send_frame(self, frame):
+        self.agent.send(frame.encoded)
+
+    def send_data(self, data):
+        self.agent.send(data)
+
+    def send_batch(self, messages):
+        # bytes (compressed) are sent as a binary frame
+        self.agent.send(encode_batch(messages))
+
     def shutdown(self):
         self.agent.disconnect()
 
@@ -305,6 +619,17 @@ class ServerTest(unittest.TestCase):
         def send(self, msg_type, **args):
             self.messages.append((msg_type, args))
 
+        def send_frame(self, frame):
+            self.send_data(frame.encoded)
+
+        def send_data(self, data):
+            data = json.loads(data)
+            self.send(data.pop('type'), **data)
+
+        def send_batch(self, messages):
+            for msg in messages:
+                self.send('replay', msg=msg)
+
         def shutdown(self):
             self.disconnected = True
 
@@ -330,7 +655,8 @@ class ServerTest(unittest.TestCase):
         player2.on_join(nick='Washizu', key=player1.key)
         self.assertEquals(len(self.server.waiting_players), 0)
         self.assertEquals(len(self.server.rooms), 1)
-        self.assertEquals(self.server.rooms[0].nicks, ['Akagi', 'Washizu'])
+        room, = self.server.rooms
+        self.assertEquals(room.nicks, ['Akagi', 'Washizu'])
         self.assertEquals(player1.messages[0][0], 'room')
         self.assertEquals(player2.messages[0][0], 'room')
 
@@ -339,6 +665,185 @@ class ServerTest(unittest.TestCase):
         player1.on_join(nick='Akagi', key='nonexistent key')
         self.assertEquals(player1.messages[0][0], 'join_failed')
 
+    def test_bots(self):
+        self.server.add_bots()
+        games = self.server.describe_games()
+        self.assertEqual(sorted(game['difficulty'] for game in games),
+                         sorted(DIFFICULTIES))
+        self.server.add_bots()
+        self.assertEqual(len(self.server.waiting_players), len(DIFFICULTIES))
+
+        key, = [game['key'] for game in games if game['difficulty'] == 'fast']
+        player = self.MockSocketPlayer(self.server)
+        player.on_join(nick='Akagi', key=key)
+        room, = self.server.rooms
+        self.assertEqual(room.difficulties, ['fast', None])
+        room.abort()
+
+    def test_timeout(self):
+        player1 = self.MockSocketPlayer(self.server)
+        player1.on_new_game(nick='Akagi')
+        player2 = self.MockSocketPlayer(self.server)
+        player2.on_join(nick='Washizu', key=player1.key)
+        room, = self.server.rooms
+        for i in range(Game.HAND_TIME_LIMIT + Game.EXTRA_TIME):
+            self.assertFalse(room.finished)
+            self.server.beat()
+        self.assertTrue(room.finished)
+        self.assertEqual(player1.messages[-1][0], 'abort')
+        self.assertEqual(len(self.server.room_timers), 0)
+
+    def test_actors(self):
+        server = GameServer(':memory:', use_actors=True)
+        player1 = self.MockSocketPlayer(server)
+        player1.on_new_game(nick='Akagi')
+        player2 = self.MockSocketPlayer(server)
+        player2.on_join(nick='Washizu', key=player1.key)
+        room, = server.rooms
+        self.assertIsNotNone(room.actor)
+
+        player1.on_hand(hand=['X1'])
+        self.assertFalse(room.finished)
+        gevent.sleep(0)
+        self.assertTrue(room.finished)
+        self.assertEqual(player2.messages[-1][0], 'abort')
+        self.assertIsNone(room.actor)
+        server.log_mailbox_stats()
+
+    def test_actor_zombie(self):
+        server = GameServer(':memory:', use_actors=True)
+        player1 = self.MockSocketPlayer(server)
+        player1.on_new_game(nick='Akagi')
+        player2 = self.MockSocketPlayer(server)
+        player2.on_join(nick='Washizu', key=player1.key)
+        room, = server.rooms
+        room.game.moves = [None, None]
+        room.schedule()
+
+        server.t = Room.ZOMBIE_TIME
+        server.beat()
+        gevent.sleep(0)
+        # aborted on the tick the deadline expires
+        self.assertTrue(room.aborted)
+
+    def test_spectate(self):
+        player1 = self.MockSocketPlayer(self.server)
+        player1.on_new_game(nick='Akagi')
+        player2 = self.MockSocketPlayer(self.server)
+        player2.on_join(nick='Washizu', key=player1.key)
+        room, = self.server.rooms
+        game, = [g for g in self.server.describe_games() if g['type'] == 'game']
+
+        spectator = self.MockSocketPlayer(self.server)
+        spectator.on_spectate(room_id=game['id'])
+        self.assertEqual(room.spectators, [spectator.spectator])
+        player1.on_hand(hand=['X1'])
+        gevent.sleep(0)
+        self.assertEqual([msg_type for msg_type, msg in spectator.messages],
+                         ['spectate', 'abort'])
+
+        # the game is over, so the writer exits after sending the rest
+        self.assertEqual(room.spectators, [])
+        self.assertTrue(spectator.spectator.thread.dead)
+        spectator.recv_disconnect()
+        self.assertIsNone(spectator.spectating)
+
+        other = self.MockSocketPlayer(self.server)
+        other.on_spectate(room_id=12345)
+        self.assertEqual(other.messages[-1][0], 'spectate_failed')
+
+    def test_rejoin(self):
+        player1 = self.MockSocketPlayer(self.server)
+        player1.on_new_game(nick='Akagi')
+        player2 = self.MockSocketPlayer(self.server)
+        player2.on_join(nick='Washizu', key=player1.key)
+        room, = self.server.rooms
+
+        player3 = self.MockSocketPlayer(self.server)
+        player3.on_rejoin(key=room.keys[1])
+        self.assertTrue(player2.disconnected)
+        self.assertIs(room.players[1], player3)
+        self.assertEqual(player3.messages[0][0], 'room')
+
+        player4 = self.MockSocketPlayer(self.server)
+        player4.on_rejoin(key='nonexistent key')
+        self.assertEqual(player4.messages, [])
+        room.abort()
+
+    def test_lobby(self):
+        watcher = self.MockSocketPlayer(self.server)
+        watcher.on_subscribe_games()
+        self.assertEqual(watcher.messages, [('games', {'games': [], 'version': 0})])
+
+        player1 = self.MockSocketPlayer(self.server)
+        player1.on_new_game(nick='Akagi')
+        player2 = self.MockSocketPlayer(self.server)
+        player2.on_subscribe_games()
+        player2.on_join(nick='Washizu', key=player1.key)
+        room, = self.server.rooms
+        room.abort()
+
+        diffs = [msg for msg_type, msg in watcher.messages
+                 if msg_type == 'games_diff']
+        self.assertEqual([(diff['set'], diff['remove']) for diff in diffs], [
+            ([{'type': 'player', 'nick': 'Akagi', 'key': player1.key,
+               'lobby_id': 'player:' + player1.key}], []),
+            ([], ['player:' + player1.key]),
+            ([{'type': 'game', 'nicks': ['Akagi', 'Washizu'], 'id': room.id,
+               'lobby_id': 'game:%d' % room.id}], []),
+            ([], ['game:%d' % room.id]),
+        ])
+        self.assertEqual(self.server.describe_games(), [])
+        # player2 stops getting updates after joining
+        self.assertNotIn('games_diff', [msg_type for msg_type, _ in player2.messages])
+
+        old_client = self.MockSocketPlayer(self.server)
+        old_client.on_get_games()
+        self.assertEqual(old_client.messages, [('games', {'games': [], 'version': 4})])
+
+    def test_suggest(self):
+        player1 = self.MockSocketPlayer(self.server)
+        player1.on_new_game(nick='Akagi')
+        player2 = self.MockSocketPlayer(self.server)
+        player2.on_join(nick='Washizu', key=player1.key)
+        room, = self.server.rooms
+        room.suggestions[0] = Suggestions(['M1'] * 13, {})
+        room.suggestions[0].hands = [{'hand': ['M1'] * 13, 'waits': [], 'value': 0}] * 5
+
+        player1.on_suggest(k=2)
+        self.assertEqual(player1.messages[-1],
+                         ('suggestions', {'hands': room.suggestions[0].hands[:2]}))
+        player1.on_suggest(k=-5)
+        self.assertEqual(len(player1.messages[-1][1]['hands']), 1)
+        player1.on_suggest(k=10**9)
+        self.assertEqual(len(player1.messages[-1][1]['hands']), Suggestions.MAX_HANDS)
+        player1.on_suggest(k='3')
+        self.assertEqual(player1.messages[-1], ('suggestions', {'hands': []}))
+        room.abort()
+
+    def test_suggest_search(self):
+        player1 = self.MockSocketPlayer(self.server)
+        player1.on_new_game(nick='Akagi')
+        player2 = self.MockSocketPlayer(self.server)
+        player2.on_join(nick='Washizu', key=player1.key)
+        room, = self.server.rooms
+
+        with unittest.mock.patch.object(Suggestions, 'TIME_BUDGET', 1):
+            player1.on_suggest(k=2)
+            job = room.suggestions[0].job
+            self.assertEqual(job.priority, BotScheduler.PRIORITY_LOW)
+            job.thread.join()
+        msg_type, msg = player1.messages[-1]
+        self.assertEqual(msg_type, 'suggestions')
+        self.assertEqual(len(msg['hands']), 2)
+        tiles = room.game.initial_tiles[0]
+        for hand in msg['hands']:
+            self.assertEqual(len(hand['hand']), 13)
+            self.assertTrue(hand['waits'])
+            for tile in set(hand['hand']):
+                self.assertLessEqual(hand['hand'].count(tile), tiles.count(tile))
+        room.abort()
+
     def test_abort(self):
         player1 = self.MockSocketPlayer(self.server)
         player1.on_new_game(nick='Akagi')
@@ -350,22 +855,258 @@ class ServerTest(unittest.TestCase):
         self.assertEquals(player1.messages[-1][0], 'abort')
         self.assertEquals(player2.messages[-1][0], 'abort')
 
-        room = self.server.rooms[0]
+        room, = self.server.rooms
         self.assertTrue(room.finished)
 
+    def test_checkpoint_busy_room(self):
+        def slow_compute(fn, *args):
+            gevent.sleep(0.01)
+            return fn(*args)
+
+        server = GameServer(':memory:', compute=slow_compute)
+        player1 = self.MockSocketPlayer(server)
+        player1.on_new_game(nick='Akagi')
+        player2 = self.MockSocketPlayer(server)
+        player2.on_join(nick='Washizu', key=player1.key)
+        room, = server.rooms
+        room.needs_checkpoint = lambda: True
+        saved = []
+        server.db.save_room = saved.append
+
+        hand = list(room.game.initial_tiles[0][:13])
+        thread = gevent.spawn(player1.on_hand, hand=hand)
+        gevent.sleep(0)
+        # doesn't wait for the move to be handled
+        server.checkpoint_rooms()
+        self.assertEqual(saved, [])
+        thread.join()
+        server.checkpoint_rooms()
+        self.assertEqual(saved, [room])
+        room.abort()
+
+    def test_evict(self):
+        player1 = self.MockSocketPlayer(self.server)
+        player1.on_new_game(nick='Akagi')
+        player2 = self.MockSocketPlayer(self.server)
+        player2.on_join(nick='Washizu', key=player1.key)
+        room, = self.server.rooms
+        self.assertEqual(self.server.rooms.finished_rooms(), [])
+        room.abort()
+        self.assertEqual(self.server.rooms.finished_rooms(), [room])
+
+        self.server.checkpoint_rooms()
+        # saved, so not checked anymore
+        self.assertEqual(self.server.dirty_rooms, set())
+        self.assertTrue(self.server.db.load_room(room.id).finished)
+        # the players are still there
+        self.server.evict_rooms()
+        self.assertEqual(len(self.server.rooms), 1)
+
+        self.server.remove_player(player1)
+        self.server.remove_player(player2)
+        self.server.evict_rooms()
+        self.assertEqual(len(self.server.rooms), 0)
+        self.assertEqual(self.server.rooms.finished_rooms(), [])
+
+    def test_journal(self):
+        player1 = self.MockSocketPlayer(self.server)
+        player1.on_new_game(nick='Akagi')
+        player2 = self.MockSocketPlayer(self.server)
+        player2.on_join(nick='Washizu', key=player1.key)
+        room, = self.server.rooms
+        hand = list(room.game.initial_tiles[0][:13])
+        player1.on_hand(hand=hand)
+
+        # not enough events for a checkpoint yet
+        self.assertFalse(room.needs_checkpoint())
+        loaded_room = self.server.db.load_room(room.id)
+        self.assertEqual(loaded_room.game.hand[0], hand)
+        self.assertEqual(loaded_room.log.entries, room.log.entries)
+        room.abort()
+
+
+class ServerSoakTest(unittest.TestCase):
+    '''Runs the server on a virtual clock.'''
+
+    N_ROOMS = 200
+
+    class IdlePlayer(ServerTest.MockSocketPlayer):
+        # never moves, and leaves when the game is over
+        def send(self, msg_type, **args):
+            if msg_type == 'abort':
+                self.server.remove_player(self)
+
+    def test_soak(self):
+        clock = VirtualClock()
+        server = GameServer(':memory:', clock=clock, use_actors=True)
+        for i in range(self.N_ROOMS):
+            player1 = self.IdlePlayer(server)
+            player1.on_new_game(nick='Akagi')
+            player2 = self.IdlePlayer(server)
+            player2.on_join(nick='Washizu', key=player1.key)
+        self.assertEqual(len(server.rooms), self.N_ROOMS)
+
+        server.start_timer()
+        try:
+            while clock.now() < 2*60*60:
+                gevent.sleep(0)
+        finally:
+            server.timer.stop()
+
+        # all games timed out, and were removed from memory
+        self.assertGreaterEqual(server.t, 2*60*60 - 1)
+        self.assertEqual(len(server.room_timers), 0)
+        self.assertEqual(len(server.rooms), 0)
+
+
+class ShardedServerTest(unittest.TestCase):
+    '''Two workers in one process, talking over localhost.'''
+
+    class MockAgent(object):
+        def __init__(self):
+            self.messages = []
+            self.proxy = None
+
+        def send(self, data):
+            self.messages.append(json.loads(data))
+
+        def emit(self, msg_type, **msg):
+            self.send(encode(msg_type, **msg))
+
+        def disconnect(self):
+            pass
+
+    def setUp(self):
+        addresses = []
+        for i in range(2):
+            sock = gevent.socket.socket()
+            sock.bind(('127.0.0.1', 0))
+            addresses.append(sock.getsockname())
+            sock.close()
+        self.servers = [GameServer(':memory:', shards=Shards(i, 2, addresses))
+                        for i in range(2)]
+        for server in self.servers:
+            server.start_shard()
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop_shard()
+
+    def connect(self, server):
+        return SocketPlayer(server, self.MockAgent())
+
+    def send(self, player, msg_type, **msg):
+        # what MinefieldAgent.on_message does
+        if player.agent.proxy:
+            player.agent.proxy.send(encode(msg_type, **msg))
+        else:
+            dispatch_message(player, encode(msg_type, **msg))
+
+    def wait_for(self, condition):
+        for i in range(100):
+            if condition():
+                return
+            gevent.sleep(0.01)
+        self.fail('condition not met')
+
+    def test_hand_off(self):
+        server0, server1 = self.servers
+        player1 = self.connect(server0)
+        self.assertEqual(server0.key_shard(player1.key), 0)
+        self.send(player1, 'new_game', nick='Akagi')
+        # the waiting player shows up in the other worker's lobby
+        lobby_id = 'player:' + player1.key
+        self.wait_for(lambda: lobby_id in server1.lobby.items)
+
+        player2 = self.connect(server1)
+        self.send(player2, 'join', nick='Washizu', key=player1.key)
+        self.wait_for(lambda: any(msg['type'] == 'room' for msg in player2.agent.messages))
+        room, = server0.rooms
+        self.assertEqual(len(server1.rooms), 0)
+        self.assertEqual([server0.key_shard(key) for key in room.keys], [0, 0])
+        game_id = 'game:%d' % server0.room_ref(room)
+        self.wait_for(lambda: game_id in server1.lobby.items)
+        self.assertNotIn(lobby_id, server1.lobby.items)
+
+        # the proxied player can play
+        self.wait_for(lambda: any(msg['type'] == 'phase_one' for msg in player2.agent.messages))
+        hand = list(room.game.initial_tiles[1][:13])
+        self.send(player2, 'hand', hand=hand)
+        self.wait_for(lambda: room.game.hand[1] == hand)
+
+        # rejoining through the other worker
+        player3 = self.connect(server1)
+        self.send(player3, 'rejoin', key=room.keys[1])
+        self.wait_for(lambda: room.players[1] is not None and
+                      room.players[1].agent is not player2.agent and
+                      any(msg['type'] == 'room' for msg in player3.agent.messages))
+
+        room.abort()
+        self.wait_for(lambda: game_id not in server1.lobby.items)
+
+    def test_bots(self):
+        server0, server1 = self.servers
+        server0.add_bots()
+        server1.add_bots()
+        player = self.connect(server1)
+        self.send(player, 'new_game', nick='Akagi')
+        self.wait_for(lambda: 'player:' + player.key in server0.lobby.items)
+
+        # every worker shows only its own bots
+        for server in self.servers:
+            bots = [item for item in server.lobby.games() if 'difficulty' in item]
+            self.assertEqual(sorted(bot['difficulty'] for bot in bots),
+                             sorted(DIFFICULTIES))
+            self.assertEqual({server.key_shard(bot['key']) for bot in bots},
+                             {server.shards.index})
+
+    def test_hand_off_failed(self):
+        server0, server1 = self.servers
+        player = self.connect(server1)
+        self.send(player, 'subscribe_games')
+        key = make_key(shard=(0, 2))
+        self.send(player, 'join', nick='Washizu', key=key)
+        self.wait_for(lambda: any(msg['type'] == 'join_failed'
+                                  for msg in player.agent.messages))
+
+        # the player still gets lobby updates, through the other worker
+        player1 = self.connect(server1)
+        self.send(player1, 'new_game', nick='Akagi')
+        self.wait_for(lambda: any(msg['type'] == 'games_diff' and
+                                  msg['set'] and
+                                  msg['set'][0].get('key') == player1.key
+                                  for msg in player.agent.messages))
+
 
 def main():
     parser = argparse.ArgumentParser(description='Serve the Minefield Mahjong application.')
     parser.add_argument('--host', metavar='IP', type=str, default='127.0.0.1')
     parser.add_argument('--port', metavar='PORT', type=int, default=8080)
     parser.add_argument('--debug', action='store_true', default=False, help='Debug mode (serve static files as well)')
+    parser.add_argument('--workers', metavar='N', type=int, default=1,
+                        help='Number of worker processes (rooms are sharded between them)')
+    parser.add_argument('--shard', type=int, default=None, help=argparse.SUPPRESS)
     args = parser.parse_args()
 
     init_logging()
 
+    if args.workers > 1 and args.shard is None:
+        print('Starting %d workers:' % args.workers, args)
+        run_workers([sys.executable, os.path.abspath(__file__)] + sys.argv[1:],
+                    args.workers)
+        return
+
     print('Starting server:', args)
-    fname = os.path.join(os.path.dirname(__file__), 'minefield.db')
-    server = GameServer(fname, use_bots=True)
+    if args.workers > 1:
+        shards = Shards.local(args.shard, args.workers, args.port)
+        # every worker has its own database
+        fname = os.path.join(os.path.dirname(__file__),
+                             'minefield.%d.db' % args.shard)
+    else:
+        shards = None
+        fname = os.path.join(os.path.dirname(__file__), 'minefield.db')
+    server = GameServer(fname, use_bots=True, compute=ThreadCompute(),
+                        use_actors=True, shards=shards)
 
     def shutdown():
         server.stop(immediate=True)
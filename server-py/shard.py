@@ -0,0 +1,308 @@
+'''Running the server as several worker processes.
+
+Every worker listens on the same public port (SO_REUSEPORT), and owns the
+rooms and waiting players whose keys hash to its shard (see
+utils.key_shard). A connection that asks for a key owned by another worker
+is forwarded there over an internal TCP connection (ShardProxy), so clients
+don't notice the sharding.
+
+The internal protocol is one JSON object per line. The proxy sends the
+client's messages as they are; the worker answers with {"text": ...} or
+{"binary": <base64>} for every message it would send to the client.
+'''
+
+import base64
+import json
+import logging
+import signal
+import subprocess
+import sys
+import unittest
+
+import gevent
+import gevent.event
+import gevent.lock
+from gevent import socket
+from gevent.server import StreamServer
+
+from lobby import Lobby
+from utils import make_key, key_shard
+
+logger = logging.getLogger('shard')
+
+
+class Shards(object):
+    def __init__(self, index, count, addresses):
+        # index of this worker, and internal (host, port) of every worker
+        self.index = index
+        self.count = count
+        self.addresses = addresses
+
+    @classmethod
+    def local(cls, index, count, port):
+        '''Workers on the same machine, with internal ports following the
+        public one.'''
+        return cls(index, count,
+                   [('127.0.0.1', port + 1 + i) for i in range(count)])
+
+
+def reuse_port_listener(host, port):
+    '''A listening socket that other processes can bind to as well. The
+    kernel distributes new connections between them.'''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+    return sock
+
+
+def encode_line(data):
+    if isinstance(data, bytes):
+        frame = {'binary': base64.b64encode(data).decode()}
+    else:
+        frame = {'text': data}
+    return (json.dumps(frame) + '\n').encode()
+
+
+def decode_line(line):
+    frame = json.loads(line)
+    if 'binary' in frame:
+        return base64.b64decode(frame['binary'])
+    return frame['text']
+
+
+class InternalAgent(object):
+    '''Connection from another worker, standing in for the client's
+    websocket (see MinefieldAgent).'''
+
+    def __init__(self, sock):
+        self.sock = sock
+        # messages are sent from room and spectator greenlets as well
+        self.lock = gevent.lock.Semaphore()
+
+    def send(self, data):
+        with self.lock:
+            self.sock.sendall(encode_line(data))
+
+    def emit(self, msg_type, **msg):
+        self.send(json.dumps({'type': msg_type, **msg}))
+
+    def disconnect(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class ShardProxy(object):
+    '''Forwards a client's messages to another worker, and the worker's
+    messages back. close() is called when the worker closes the
+    connection, but not after a local ShardProxy.close().'''
+
+    def __init__(self, address, send, close):
+        self.send_data = send
+        self.on_close = close
+        self.closing = False
+        self.sock = socket.create_connection(address)
+        self.closed = gevent.event.Event()
+        self.thread = gevent.spawn(self.run)
+
+    def send(self, message):
+        # newlines in JSON can only be whitespace
+        self.sock.sendall((message.replace('\n', ' ') + '\n').encode())
+
+    def run(self):
+        try:
+            for line in self.sock.makefile('rb'):
+                self.send_data(decode_line(line))
+        except Exception:
+            if not self.closing:
+                logger.exception('error in shard proxy')
+        finally:
+            self.sock.close()
+            self.closed.set()
+            if not self.closing:
+                self.on_close()
+
+    def close(self):
+        self.closing = True
+        self.sock.close()
+        self.thread.kill(block=False)
+
+
+def is_bot(item):
+    return 'difficulty' in item
+
+
+class LobbyMirror(object):
+    '''Lobby subscriber copying the items of one lobby into another. Items
+    for which exclude(item) is true are not copied.'''
+
+    def __init__(self, lobby, exclude=None):
+        self.lobby = lobby
+        self.exclude = exclude
+        self.ids = set()
+
+    def send_data(self, data):
+        msg = json.loads(data)
+        if msg['type'] == 'games':
+            items, remove = msg['games'], self.ids.copy()
+        else:
+            items, remove = msg['set'], set(msg['remove'])
+        if self.exclude:
+            remove.update(item['lobby_id'] for item in items
+                          if self.exclude(item) and item['lobby_id'] in self.ids)
+            items = [item for item in items if not self.exclude(item)]
+        for item in items:
+            remove.discard(item['lobby_id'])
+        for lobby_id in list(remove):
+            self.lobby.remove(lobby_id)
+            self.ids.discard(lobby_id)
+        for item in items:
+            self.lobby.set(item['lobby_id'], item)
+            self.ids.add(item['lobby_id'])
+
+    def clear(self):
+        for lobby_id in self.ids:
+            self.lobby.remove(lobby_id)
+        self.ids = set()
+
+
+def follow_lobby(address, lobby, retry_interval=1):
+    '''Mirror the lobby of another worker, reconnecting when it goes
+    away.
+
+    Every worker advertises its own bots, and shows only these: a client
+    playing against a bot plays on the worker it is connected to, so the
+    bot games (and searches) are spread between the workers.
+    '''
+    mirror = LobbyMirror(lobby, exclude=is_bot)
+    while True:
+        try:
+            proxy = ShardProxy(address, mirror.send_data, lambda: None)
+        except OSError:
+            gevent.sleep(retry_interval)
+            continue
+        logger.info('following the lobby of %s:%d', *address)
+        proxy.send(json.dumps({'type': 'subscribe_shard'}))
+        proxy.closed.wait()
+        mirror.clear()
+        gevent.sleep(retry_interval)
+
+
+def run_workers(command, count, restart_interval=1):
+    '''Run count copies of the server, passing '--shard N' to each, and
+    restart the ones that exit. Stops all of them on SIGINT/SIGTERM.'''
+    processes = [None] * count
+    stopping = gevent.event.Event()
+
+    def stop():
+        stopping.set()
+        for process in processes:
+            if process and process.poll() is None:
+                process.send_signal(signal.SIGINT)
+
+    gevent.signal(signal.SIGINT, stop)
+    gevent.signal(signal.SIGTERM, stop)
+
+    while not stopping.is_set():
+        for i, process in enumerate(processes):
+            if process and process.poll() is None:
+                continue
+            if process:
+                logger.warning('worker %d exited with %d, restarting',
+                               i, process.returncode)
+            processes[i] = subprocess.Popen(command + ['--shard', str(i)])
+        stopping.wait(restart_interval)
+
+    for process in processes:
+        process.wait()
+    sys.exit(0)
+
+
+class ShardsTest(unittest.TestCase):
+    def test_make_key(self):
+        for i in range(3):
+            key = make_key(shard=(i, 3))
+            self.assertEqual(key_shard(key, 3), i)
+
+    def test_encode_line(self):
+        for data in ['{"type": "ron"}', b'\x00\xff\n']:
+            line = encode_line(data)
+            self.assertEqual(line.count(b'\n'), 1)
+            self.assertEqual(decode_line(line), data)
+
+    def test_proxy(self):
+        def echo(sock, address):
+            agent = InternalAgent(sock)
+            for line in sock.makefile('rb'):
+                if b'quit' in line:
+                    break
+                agent.send(line.decode().strip())
+                agent.send(b'binary')
+            agent.disconnect()
+
+        echo_server = StreamServer(('127.0.0.1', 0), echo)
+        echo_server.start()
+        received = []
+        closed = []
+        proxy = ShardProxy(echo_server.address, received.append,
+                           lambda: closed.append(True))
+        proxy.send('{"type":\n"join"}')
+        gevent.sleep(0.1)
+        self.assertEqual(received, ['{"type": "join"}', b'binary'])
+
+        # closed locally: no callback
+        with self.assertLogs('shard', level='ERROR') as logs:
+            proxy.close()
+            proxy.closed.wait(1)
+            logger.error('(nothing else logged)')
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual(closed, [])
+
+        # closed by the worker
+        proxy = ShardProxy(echo_server.address, received.append,
+                           lambda: closed.append(True))
+        proxy.send('{"type": "quit"}')
+        proxy.closed.wait(1)
+        self.assertEqual(closed, [True])
+        echo_server.stop()
+
+
+class LobbyMirrorTest(unittest.TestCase):
+    def test_mirror(self):
+        source, target = Lobby(), Lobby()
+        target.set('player:A', {'type': 'player'})
+        source.set('player:B', {'type': 'player'})
+        mirror = LobbyMirror(target)
+        source.subscribe(mirror)
+        source.set('game:1', {'type': 'game'})
+        source.remove('player:B')
+        self.assertEqual([item['lobby_id'] for item in target.games()],
+                         ['player:A', 'game:1'])
+
+        # full list again, e.g. after reconnecting
+        source.remove('game:1')
+        source.unsubscribe(mirror)
+        source.set('player:C', {'type': 'player'})
+        source.subscribe(mirror)
+        self.assertEqual([item['lobby_id'] for item in target.games()],
+                         ['player:A', 'player:C'])
+
+        mirror.clear()
+        self.assertEqual([item['lobby_id'] for item in target.games()],
+                         ['player:A'])
+
+    def test_exclude(self):
+        source, target = Lobby(), Lobby()
+        source.set('player:B', {'type': 'player', 'difficulty': 'fast'})
+        source.set('player:C', {'type': 'player'})
+        source.subscribe(LobbyMirror(target, exclude=is_bot))
+        source.set('player:D', {'type': 'player', 'difficulty': 'fast'})
+        self.assertEqual([item['lobby_id'] for item in target.games()],
+                         ['player:C'])
+
+
+if __name__ == '__main__':
+    unittest.main()
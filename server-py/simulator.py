@@ -0,0 +1,264 @@
+'''Headless self-play: bot vs bot games without rooms or sockets.
+
+Drives Game directly through its callback API, so that bot strength and
+search speed can be measured over many games:
+
+    python simulator.py --games 1000 --processes 8 --seed 1
+
+Searches use the families of a bot difficulty level (see
+bot_player.DIFFICULTIES), but a much shorter time budget than real games,
+so that thousands of games per minute can be played. Pass a larger
+--time-budget to measure bot strength closer to the real thing.
+'''
+
+import argparse
+import json
+import multiprocessing
+import functools
+import time
+import unittest
+from collections import deque, Counter
+
+from game import Game
+from bot import Bot, SearchStats
+from bot_player import DIFFICULTIES, DEFAULT_DIFFICULTY, eval_caches
+
+# Default search time per hand, in seconds
+TIME_BUDGET = 0.05
+
+
+class SimPlayer(object):
+    '''Synchronous counterpart of BotPlayer, timing every decision.'''
+
+    def __init__(self, bot_class=Bot, difficulty=DEFAULT_DIFFICULTY,
+                 time_budget=TIME_BUDGET, families=None):
+        self.bot_class = bot_class
+        self.difficulty = difficulty
+        self.time_budget = time_budget
+        self.families = families or DIFFICULTIES[difficulty]['families']
+        self.bot = None
+        self.found_tenpai = False
+        self.hand_time = 0.
+        self.discard_times = []
+
+    def on_phase_one(self, msg):
+        if msg['east'] == msg['you']:
+            fanpai_wind = 'X1'
+        else:
+            fanpai_wind = 'X2'
+        self.bot = self.bot_class(
+            tiles=msg['tiles'],
+            options={
+                'dora_ind': msg['dora_ind'],
+                'fanpai_winds': [fanpai_wind],
+            },
+            families=self.families,
+            eval_cache=eval_caches.get(self.difficulty),
+        )
+
+    def choose_hand(self):
+        start = time.perf_counter()
+        hand = self.bot.choose_tenpai(time_budget=self.time_budget)
+        self.found_tenpai = bool(hand)
+        if not hand:
+            hand = self.bot.choose_any_hand()
+        self.hand_time = time.perf_counter() - start
+        return hand
+
+    def choose_discard(self):
+        start = time.perf_counter()
+        tile = self.bot.discard()
+        self.discard_times.append(time.perf_counter() - start)
+        return tile
+
+
+def play_game(seed, bot_class=Bot, **settings):
+    '''Play a single game with a deal determined by seed. Returns a dict
+    describing the outcome. Settings are passed to SimPlayer.'''
+
+    messages = deque()
+
+    def callback(to_player, msg_type, **msg):
+        messages.append((to_player, msg_type, msg))
+
+    game = Game(callback=callback, seed=seed)
+    players = [SimPlayer(bot_class, **settings),
+               SimPlayer(bot_class, **settings)]
+
+    result = {
+        'seed': seed,
+        'east': game.east,
+        'result': None,
+    }
+
+    game.start()
+    while messages:
+        idx, msg_type, msg = messages.popleft()
+        player = players[idx]
+        if msg_type == 'phase_one':
+            player.on_phase_one(msg)
+        elif msg_type == 'hand':
+            player.bot.use_tenpai(msg['hand'])
+        elif msg_type == 'discarded':
+            if msg['player'] == idx:
+                player.bot.use_discard(msg['tile'])
+            else:
+                player.bot.opponent_discard(msg['tile'])
+        elif msg_type == 'start_move':
+            if msg['move_type'] == 'hand':
+                game.on_hand(idx, hand=player.choose_hand())
+            else:
+                game.on_discard(idx, tile=player.choose_discard())
+        elif msg_type in ['ron', 'draw', 'abort'] and result['result'] is None:
+            result['result'] = msg_type
+            if msg_type == 'ron':
+                result.update(
+                    winner=msg['player'],
+                    points=msg['points'],
+                    limit=msg['limit'],
+                    yaku=msg['yaku'],
+                    dora=msg['dora'],
+                )
+            elif msg_type == 'abort':
+                result.update(culprit=msg['culprit'],
+                              description=msg['description'])
+
+    result.update(
+        discards=len(game.discards[0]) + len(game.discards[1]),
+        tenpai=[p.found_tenpai for p in players],
+        hand_time=[p.hand_time for p in players],
+        discard_time=max(t for p in players for t in p.discard_times or [0.]),
+    )
+    return result
+
+
+def simulate(seeds, processes=1, bot_class=Bot, **settings):
+    '''Play a game for each seed, yielding results in completion order.'''
+
+    play = functools.partial(play_game, bot_class=bot_class, **settings)
+    if processes == 1:
+        yield from map(play, seeds)
+        return
+
+    with multiprocessing.Pool(processes) as pool:
+        yield from pool.imap_unordered(play, seeds, chunksize=4)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def summarize(results):
+    results = list(results)
+    outcomes = Counter(r['result'] for r in results)
+    wins = [r for r in results if r['result'] == 'ron']
+    yaku = Counter(y for r in wins for y in r['yaku'])
+    hand_times = [t for r in results for t in r['hand_time']]
+    return {
+        'games': len(results),
+        'outcomes': dict(outcomes),
+        'east_wins': sum(1 for r in wins if r['winner'] == r['east']),
+        'tenpai_rate': (sum(sum(r['tenpai']) for r in results) /
+                        max(1, 2 * len(results))),
+        'mean_points': (sum(r['points'] for r in wins) / max(1, len(wins))),
+        'yaku': dict(yaku.most_common()),
+        'hand_time': {
+            'p50': percentile(hand_times, 0.5),
+            'p95': percentile(hand_times, 0.95),
+            'max': percentile(hand_times, 1),
+        },
+        'discard_time_max': max((r['discard_time'] for r in results),
+                                default=0.),
+    }
+
+
+class SimulatorTest(unittest.TestCase):
+    class QuickBot(Bot):
+        # Skip the expensive search, we're testing the driver here.
+        def choose_tenpai(self, cooperative=False, time_budget=None):
+            return None
+
+    def test_play_game(self):
+        result = play_game(1, bot_class=self.QuickBot)
+        self.assertIn(result['result'], ['ron', 'draw'])
+        self.assertEqual(result['tenpai'], [False, False])
+        if result['result'] == 'draw':
+            self.assertEqual(result['discards'], 34)
+
+    def test_deterministic(self):
+        def strip(result):
+            return {k: v for k, v in result.items()
+                    if k not in ['hand_time', 'discard_time']}
+
+        results1 = list(simulate([1, 2, 3], bot_class=self.QuickBot))
+        results2 = list(simulate([1, 2, 3], bot_class=self.QuickBot))
+        self.assertEqual([strip(r) for r in results1],
+                         [strip(r) for r in results2])
+
+    def test_summarize(self):
+        summary = summarize(simulate(range(5), bot_class=self.QuickBot))
+        self.assertEqual(summary['games'], 5)
+        self.assertEqual(sum(summary['outcomes'].values()), 5)
+
+    def test_settings(self):
+        result = play_game(1, difficulty='fast', time_budget=0.01,
+                           families=['4groups'])
+        self.assertIn(result['result'], ['ron', 'draw', 'abort'])
+        # the budget is checked between candidates, so allow some slack
+        self.assertLess(max(result['hand_time']), 0.5)
+
+        player = SimPlayer(difficulty='fast')
+        self.assertEqual(player.families, DIFFICULTIES['fast']['families'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run bot self-play games.')
+    parser.add_argument('--games', metavar='N', type=int, default=100)
+    parser.add_argument('--seed', metavar='SEED', type=int, default=0,
+                        help='Seed of the first game (the rest are consecutive)')
+    parser.add_argument('--processes', metavar='N', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--output', metavar='FILE', type=str, default=None,
+                        help='Write per-game results as JSON lines')
+    parser.add_argument('--difficulty', choices=sorted(DIFFICULTIES),
+                        default=DEFAULT_DIFFICULTY,
+                        help='Bot level, for the search families and cache')
+    parser.add_argument('--time-budget', metavar='SECONDS', type=float,
+                        default=TIME_BUDGET,
+                        help='Search time per hand (default: %(default)s)')
+    parser.add_argument('--families', metavar='F1,F2', type=str, default=None,
+                        help='Search families, overriding the difficulty '
+                        '(any of %s)' % ','.join(SearchStats.FAMILIES))
+    args = parser.parse_args()
+    families = args.families.split(',') if args.families else None
+    if families and not set(families) <= set(SearchStats.FAMILIES):
+        parser.error('unknown search family in %r' % args.families)
+
+    seeds = range(args.seed, args.seed + args.games)
+    start = time.perf_counter()
+    results = []
+    out = open(args.output, 'w') if args.output else None
+    try:
+        for result in simulate(seeds, args.processes,
+                               difficulty=args.difficulty,
+                               time_budget=args.time_budget,
+                               families=families):
+            results.append(result)
+            if out:
+                out.write(json.dumps(result) + '\n')
+    finally:
+        if out:
+            out.close()
+    elapsed = time.perf_counter() - start
+
+    summary = summarize(results)
+    summary['elapsed'] = elapsed
+    summary['games_per_minute'] = 60 * len(results) / max(elapsed, 1e-9)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+'''Spectators: connections watching a room's public events.'''
+
+import logging
+import unittest
+
+import gevent
+import gevent.event
+import gevent.queue
+
+logger = logging.getLogger('spectator')
+
+
+class Spectator(object):
+    '''Sends already encoded messages to a connection.
+
+    Messages are queued and written by a separate greenlet, so that a slow
+    connection never blocks the room. A spectator that falls more than
+    QUEUE_SIZE messages behind is dropped.
+    '''
+
+    QUEUE_SIZE = 64
+
+    # Queued by stop(flush=True)
+    STOP = object()
+
+    def __init__(self, send, close):
+        # send(data) writes a message, close() closes the connection
+        self.send = send
+        self.close = close
+        self.queue = gevent.queue.Queue(self.QUEUE_SIZE)
+        self.dropped = False
+        self.stopped = False
+        self.thread = gevent.spawn(self.run)
+
+    def push(self, data):
+        if self.dropped or self.stopped:
+            return
+        try:
+            self.queue.put_nowait(data)
+        except gevent.queue.Full:
+            logger.info('dropping a slow spectator')
+            self.drop()
+
+    def run(self):
+        try:
+            while True:
+                data = self.queue.get()
+                if data is self.STOP:
+                    return
+                self.send(data)
+        except gevent.GreenletExit:
+            pass
+        except Exception:
+            logger.exception('error sending to spectator')
+            self.drop()
+
+    def stop(self, flush=False):
+        '''Stop the writer, without closing the connection. With flush=True,
+        the messages already queued are sent first.'''
+        if self.stopped:
+            return
+        self.stopped = True
+        if flush:
+            try:
+                self.queue.put_nowait(self.STOP)
+                return
+            except gevent.queue.Full:
+                pass
+        if self.thread is not gevent.getcurrent():
+            self.thread.kill(block=False)
+
+    def drop(self):
+        if self.dropped:
+            return
+        self.dropped = True
+        if self.thread is not gevent.getcurrent():
+            self.thread.kill(block=False)
+        self.close()
+
+
+class SpectatorTest(unittest.TestCase):
+    def test_send(self):
+        sent = []
+        spectator = Spectator(sent.append, lambda: None)
+        spectator.push('a')
+        spectator.push('b')
+        gevent.sleep(0)
+        self.assertEqual(sent, ['a', 'b'])
+
+    def test_stop(self):
+        sent = []
+        closed = []
+        spectator = Spectator(sent.append, lambda: closed.append(True))
+        spectator.push('a')
+        spectator.stop(flush=True)
+        spectator.push('b')
+        gevent.sleep(0)
+        self.assertEqual(sent, ['a'])
+        self.assertTrue(spectator.thread.dead)
+
+        spectator = Spectator(sent.append, lambda: closed.append(True))
+        spectator.push('c')
+        spectator.stop()
+        gevent.sleep(0)
+        self.assertEqual(sent, ['a'])
+        self.assertTrue(spectator.thread.dead)
+        self.assertEqual(closed, [])
+
+    def test_drop_slow(self):
+        blocked = gevent.event.Event()
+        closed = []
+        spectator = Spectator(lambda data: blocked.wait(),
+                              lambda: closed.append(True))
+        for i in range(Spectator.QUEUE_SIZE + 2):
+            spectator.push(i)
+        self.assertTrue(spectator.dropped)
+        self.assertEqual(closed, [True])
+        spectator.push('more')
+        self.assertEqual(closed, [True])
+
+    def test_send_error(self):
+        closed = []
+
+        def send(data):
+            raise IOError('connection lost')
+
+        spectator = Spectator(send, lambda: closed.append(True))
+        spectator.push('a')
+        gevent.sleep(0)
+        self.assertTrue(spectator.dropped)
+        self.assertEqual(closed, [True])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+
+import heapq
+import itertools
+import unittest
+
+
+class TimerQueue(object):
+    '''Priority queue of deadlines. Each item has at most one pending
+    deadline; scheduling it again replaces the previous one.'''
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        # item -> entry currently in the heap; older entries are stale
+        self.entries = {}
+
+    def schedule(self, when, item):
+        entry = (when, next(self.counter), item)
+        self.entries[item] = entry
+        heapq.heappush(self.heap, entry)
+
+    def cancel(self, item):
+        self.entries.pop(item, None)
+
+    def pop_expired(self, now):
+        '''Remove and return the items with deadlines up to now.'''
+        result = []
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            item = entry[2]
+            if self.entries.get(item) is entry:
+                del self.entries[item]
+                result.append(item)
+        return result
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class TimerQueueTest(unittest.TestCase):
+    def test_pop_expired(self):
+        timers = TimerQueue()
+        timers.schedule(5, 'a')
+        timers.schedule(3, 'b')
+        timers.schedule(10, 'c')
+        self.assertEqual(timers.pop_expired(2), [])
+        self.assertEqual(timers.pop_expired(5), ['b', 'a'])
+        self.assertEqual(len(timers), 1)
+
+    def test_reschedule(self):
+        timers = TimerQueue()
+        timers.schedule(5, 'a')
+        timers.schedule(8, 'a')
+        self.assertEqual(timers.pop_expired(5), [])
+        self.assertEqual(timers.pop_expired(8), ['a'])
+        self.assertEqual(timers.pop_expired(100), [])
+
+    def test_cancel(self):
+        timers = TimerQueue()
+        timers.schedule(5, 'a')
+        timers.cancel('a')
+        self.assertEqual(timers.pop_expired(5), [])
+        self.assertEqual(len(timers), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,22 @@
 import random
+import zlib
 
 
 KEY_WIDTH = 10
 # Bitcoin's Base58 :)
 BASE_58 = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
 
-def make_key(exclude=[]):
+def make_key(exclude=[], shard=None):
+    '''Make a random key. If shard is (index, count), the key will belong to
+    that shard (see key_shard).'''
     while True:
         key = ''.join(random.choice(BASE_58) for _ in range(KEY_WIDTH))
-        if key not in exclude:
-            return key
+        if key in exclude:
+            continue
+        if shard and key_shard(key, shard[1]) != shard[0]:
+            continue
+        return key
+
+
+def key_shard(key, count):
+    return zlib.crc32(key.encode()) % count